@@ -0,0 +1,58 @@
+import sys
+from os.path import dirname, abspath, join
+
+import numpy as np
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'utils'))
+from tracking_core import cpd_lle, cpd_lle_batch
+
+beta, alpha, gamma, mu = 0.5, 1, 1, 0.05
+
+# nodes along a straight cable and a point cloud sampled along the same cable, shifted by offset
+def straight_cable (num_nodes, num_pts, start, end, offset, seed=0):
+    rng = np.random.RandomState(seed)
+    Y_0 = np.linspace(start, end, num_nodes)
+    X = np.linspace(start, end, num_pts) + offset + rng.normal(0, 0.002, (num_pts, 3))
+    return X, Y_0
+
+def test_padded_object_matches_single_object ():
+    X_long, Y_long = straight_cable(40, 300, [0, 0, 0.8], [0.4, 0, 0.8], [0, 0.01, 0])
+    X_short, Y_short = straight_cable(20, 150, [0, 0.2, 0.8], [0.2, 0.2, 0.8], [0.01, 0, 0], seed=1)
+
+    Ys, sigma2s = cpd_lle_batch([X_long, X_short], [Y_long, Y_short], beta, alpha, gamma, mu)
+    assert Ys[1].shape == Y_short.shape
+
+    for k, (X, Y_0) in enumerate([(X_long, Y_long), (X_short, Y_short)]):
+        Y, sigma2 = cpd_lle(X, Y_0, beta, alpha, gamma, mu)
+        assert np.allclose(Ys[k], Y, atol=1e-3)
+        assert np.isclose(sigma2s[k], sigma2, rtol=1e-2)
+
+def test_empty_object_is_skipped ():
+    X_a, Y_a = straight_cable(30, 200, [0, 0, 0.8], [0.3, 0, 0.8], [0, 0.01, 0])
+    _, Y_b = straight_cable(25, 1, [0, 0.2, 0.8], [0.25, 0.2, 0.8], [0, 0, 0])
+    X_b = np.zeros((0, 3))
+
+    with np.errstate(divide='raise', invalid='raise'):
+        Ys, sigma2s = cpd_lle_batch([X_a, X_b], [Y_a, Y_b], beta, alpha, gamma, mu)
+    Ys_a, sigma2s_a = cpd_lle_batch([X_a], [Y_a], beta, alpha, gamma, mu)
+
+    assert np.array_equal(Ys[1], Y_b)
+    assert sigma2s[1] == 0
+    assert np.allclose(Ys[0], Ys_a[0])
+    assert np.isclose(sigma2s[0], sigma2s_a[0])
+
+    Ys, sigma2s = cpd_lle_batch([X_b, X_b], [Y_a, Y_b], beta, alpha, gamma, mu, use_prev_sigma2=True, sigma2_0=[0.01, 0.02])
+    assert np.array_equal(Ys[0], Y_a)
+    assert np.allclose(sigma2s, [0.01, 0.02])
+
+def test_objects_with_few_nodes ():
+    for num_nodes in [2, 3, 4, 6]:
+        X_a, Y_a = straight_cable(30, 200, [0, 0, 0.8], [0.3, 0, 0.8], [0, 0.01, 0])
+        X_b, Y_b = straight_cable(num_nodes, 50, [0, 0.2, 0.8], [0.05, 0.2, 0.8], [0, 0.005, 0], seed=num_nodes)
+
+        Ys, sigma2s = cpd_lle_batch([X_a, X_b], [Y_a, Y_b], beta, alpha, gamma, mu)
+        assert Ys[1].shape == Y_b.shape
+        assert np.all(np.isfinite(Ys[1]))
+        assert np.all(np.isfinite(sigma2s))
+        # the short object follows its points
+        assert np.mean(Ys[1][:, 1]) > np.mean(Y_b[:, 1])
@@ -0,0 +1,42 @@
+import sys
+from os.path import dirname, abspath, join
+
+import numpy as np
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'utils'))
+from visibility import node_visibility, visibility_weights
+from synthetic_dlo import proj_matrix
+
+# a rope that crosses over itself: a lower segment along x at z = 0.8 and, closer to the camera, a segment along y
+# at z = 0.6 that passes right in front of the middle node of the lower segment
+def crossing_rope ():
+    lower = np.vstack((np.linspace(-0.1, 0.1, 11), np.zeros(11), np.full(11, 0.8))).T
+    link = np.array([[0.12, 0.05, 0.7]])
+    upper = np.vstack((np.zeros(11), np.linspace(0.1, -0.1, 11), np.full(11, 0.6))).T
+    return np.vstack((lower, link, upper))
+
+def test_self_occluded_node_weight ():
+    Y = crossing_rope()
+    hidden_node = 5
+    # points on every node, so that only the self-occlusion makes a node invisible
+    rng = np.random.default_rng(0)
+    X = np.repeat(Y, 10, axis=0) + rng.normal(0, 0.001, (len(Y) * 10, 3))
+
+    visible_nodes, node_pt_dists, pt_node_dists = node_visibility(Y, X, proj_matrix)
+    assert hidden_node not in visible_nodes
+    assert 0 in visible_nodes and len(Y) - 1 in visible_nodes
+
+    distance_only, _ = visibility_weights(node_pt_dists, pt_node_dists)
+    with_occlusion, _ = visibility_weights(node_pt_dists, pt_node_dists, visible_nodes=visible_nodes)
+    # without the occlusion the hidden node is weighted like its visible neighbors
+    assert abs(distance_only[hidden_node] - distance_only[0]) < 0.2
+    assert with_occlusion[hidden_node] < 0.05 * with_occlusion[0]
+    assert np.isclose(np.mean(with_occlusion), 1)
+
+def test_all_visible_weights_unchanged ():
+    Y = np.vstack((np.linspace(-0.1, 0.1, 11), np.zeros(11), np.full(11, 0.8))).T
+    X = np.repeat(Y, 5, axis=0)
+    visible_nodes, node_pt_dists, pt_node_dists = node_visibility(Y, X, proj_matrix)
+    assert len(visible_nodes) == len(Y)
+    assert np.allclose(visibility_weights(node_pt_dists, pt_node_dists)[0],
+                       visibility_weights(node_pt_dists, pt_node_dists, visible_nodes=visible_nodes)[0])
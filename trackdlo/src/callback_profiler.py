@@ -0,0 +1,134 @@
+import cProfile
+import io
+import os
+import pstats
+import signal
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+import rospy
+from std_srvs.srv import Trigger, TriggerResponse
+
+# profiles the next num_callbacks calls of the wrapped callbacks of a running node.
+# capture(n) arms the profiler; after n counted calls the merged cProfile stats are written to
+# output_dir/<prefix>_<time>.pstats together with a <prefix>_<time>.txt summary of the top functions.
+# with use_tracemalloc, allocations are traced during the capture and the peak and the top allocation sites
+# are added to the summary
+class CallbackProfiler:
+    def __init__(self, output_dir, prefix='profile', num_callbacks=100, use_tracemalloc=False, top_n=25):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.num_callbacks = num_callbacks
+        self.use_tracemalloc = use_tracemalloc
+        self.top_n = top_n
+        self.remaining = 0
+        self.profiles = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.last_output = None
+
+    def active(self):
+        return self.remaining > 0
+
+    def capture(self, num_callbacks=None):
+        with self.lock:
+            if self.remaining > 0:
+                return False
+            self.remaining = self.num_callbacks if num_callbacks is None else num_callbacks
+            self.profiles = []
+            if self.use_tracemalloc:
+                tracemalloc.start()
+            return True
+
+    # counted: whether a call uses up one of the num_callbacks. in a pipelined node, wrap both stages
+    # but count only one of them
+    def wrap(self, fn, counted=True):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if self.remaining <= 0:
+                return fn(*args, **kwargs)
+
+            # cProfile only sees the thread it is enabled in, so every thread gets its own profile
+            profile = getattr(self.local, 'profile', None)
+            if profile is None:
+                profile = cProfile.Profile()
+                self.local.profile = profile
+                with self.lock:
+                    self.profiles.append(profile)
+            profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+                if counted:
+                    self.finish_call()
+        return wrapper
+
+    def finish_call(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+            profiles = self.profiles
+            self.profiles = []
+            # other threads create new profiles for the next capture
+            self.local = threading.local()
+        self.write(profiles)
+
+    def write(self, profiles):
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        base = os.path.join(self.output_dir, self.prefix + '_' + time.strftime('%Y%m%d_%H%M%S'))
+
+        stream = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=stream)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(base + '.pstats')
+
+        stats.sort_stats('cumulative').print_stats(self.top_n)
+        stats.sort_stats('tottime').print_stats(self.top_n)
+
+        if self.use_tracemalloc and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stream.write('tracemalloc: current {:.1f} MB, peak {:.1f} MB\n'.format(current / 2**20, peak / 2**20))
+            for stat in snapshot.statistics('lineno')[:self.top_n]:
+                stream.write(str(stat) + '\n')
+
+        with open(base + '.txt', 'w') as f:
+            f.write(stream.getvalue())
+        self.last_output = base
+        rospy.loginfo('Profile written to ' + base + '.pstats')
+
+# ways to start a capture on a running node:
+#   rosparam set <param_name> N   (polled once per second, reset to 0 when the capture starts)
+#   rosservice call <service_name>
+#   kill -USR1 <pid>             (only if called from the main thread)
+def attach_profiler_triggers (profiler, param_name='~profile_callbacks', service_name='~profile'):
+    def poll_param (event):
+        num_callbacks = rospy.get_param(param_name, 0)
+        if num_callbacks > 0:
+            rospy.set_param(param_name, 0)
+            if profiler.capture(num_callbacks):
+                rospy.loginfo('Profiling the next ' + str(num_callbacks) + ' callbacks')
+
+    def handle_service (req):
+        if profiler.capture():
+            return TriggerResponse(True, 'profiling the next ' + str(profiler.num_callbacks) + ' callbacks')
+        return TriggerResponse(False, 'a capture is already running')
+
+    def handle_signal (signum, frame):
+        profiler.capture()
+
+    rospy.set_param(param_name, 0)
+    timer = rospy.Timer(rospy.Duration(1.0), poll_param)
+    service = rospy.Service(service_name, Trigger, handle_service)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, handle_signal)
+    return timer, service
@@ -17,6 +17,9 @@ from visualization_msgs.msg import MarkerArray
 from scipy import interpolate
 
 from utils import extract_connected_skeleton, ndarray2MarkerArray
+from stage_metrics import metrics
+from callback_profiler import CallbackProfiler, attach_profiler_triggers
+import os
 
 proj_matrix = None
 def camera_info_callback (info):
@@ -53,8 +56,10 @@ def callback (rgb, depth):
     global lower, upper
 
     print("Initializing...")
+    callback_start = time.time()
 
     # process rgb image
+    stage_start = time.time()
     cur_image = ros_numpy.numpify(rgb)
     hsv_image = cv2.cvtColor(cur_image.copy(), cv2.COLOR_RGB2HSV)
 
@@ -67,8 +72,9 @@ def callback (rgb, depth):
     else:
         # color thresholding
         mask = color_thresholding(hsv_image, cur_depth)
+    metrics.record('thresholding', time.time() - stage_start)
 
-    start_time = time.time()
+    stage_start = time.time()
     mask = cv2.cvtColor(mask.copy(), cv2.COLOR_GRAY2BGR)
 
     # returns the pixel coord of points (in order). a list of lists
@@ -78,7 +84,9 @@ def callback (rgb, depth):
     all_pixel_coords = []
     for chain in extracted_chains:
         all_pixel_coords += chain
-    print('Finished extracting chains. Time taken:', time.time()-start_time)
+    metrics.record('skeleton_extraction', time.time() - stage_start)
+
+    stage_start = time.time()
 
     all_pixel_coords = np.array(all_pixel_coords) * img_scale
     all_pixel_coords = np.flip(all_pixel_coords, 1)
@@ -118,9 +126,14 @@ def callback (rgb, depth):
     total_spline_len = np.sum(np.sqrt(np.sum(np.square(np.diff(spline_pts, axis=0)), axis=1)))
 
     init_nodes = spline_pts[np.linspace(0, num_true_pts-1, num_of_nodes).astype(int)]
+    metrics.record('spline_fitting', time.time() - stage_start)
+
+    stage_start = time.time()
 
-    results = ndarray2MarkerArray(init_nodes, result_frame_id, [1, 150/255, 0, 0.75], [0, 1, 0, 0.75])
-    results_pub.publish(results)
+    # the markers are only for visualization, skip them if nobody is listening
+    if results_pub.get_num_connections() > 0:
+        results = ndarray2MarkerArray(init_nodes, result_frame_id, [1, 150/255, 0, 0.75], [0, 1, 0, 0.75])
+        results_pub.publish(results)
 
     # add color
     pc_rgba = struct.unpack('I', struct.pack('BBBB', 255, 40, 40, 255))[0]
@@ -131,6 +144,12 @@ def callback (rgb, depth):
     header.stamp = rospy.Time.now()
     converted_points = pcl2.create_cloud(header, fields, pc_colored)
     pc_pub.publish(converted_points)
+    metrics.record('publishing', time.time() - stage_start)
+    metrics.record('total', time.time() - callback_start)
+
+    rospy.loginfo('Initialization timing:\n' + metrics.summary_string())
+    if metrics_csv != '':
+        metrics.dump_csv(metrics_csv)
 
     rospy.signal_shutdown('Finished initial node set computation.')
 
@@ -144,6 +163,16 @@ if __name__=='__main__':
     depth_topic = rospy.get_param('/init_tracker/depth_topic')
     result_frame_id = rospy.get_param('/init_tracker/result_frame_id')
     visualize_initialization_process = rospy.get_param('/init_tracker/visualize_initialization_process')
+    # optional csv file for the stage timings
+    metrics_csv = rospy.get_param('/init_tracker/metrics_csv', '')
+
+    # profile the initialization callback if /init_tracker/profile is true (results go to ~/.ros/profiles),
+    # or when a capture is triggered before the first frame arrives
+    profiler = CallbackProfiler(os.path.expanduser('~/.ros/profiles'), prefix='init_tracker', num_callbacks=1,
+                                use_tracemalloc=rospy.get_param('/init_tracker/profile_tracemalloc', False))
+    if rospy.get_param('/init_tracker/profile', False):
+        profiler.capture()
+    attach_profiler_triggers(profiler)
 
     hsv_threshold_upper_limit = rospy.get_param('/init_tracker/hsv_threshold_upper_limit')
     hsv_threshold_lower_limit = rospy.get_param('/init_tracker/hsv_threshold_lower_limit')
@@ -169,6 +198,6 @@ if __name__=='__main__':
     results_pub = rospy.Publisher ('/trackdlo/init_nodes_markers', MarkerArray, queue_size=10)
 
     ts = message_filters.TimeSynchronizer([rgb_sub, depth_sub], 10)
-    ts.registerCallback(callback)
+    ts.registerCallback(profiler.wrap(callback))
 
     rospy.spin()
\ No newline at end of file
@@ -0,0 +1,99 @@
+import csv
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# per-stage latency metrics, event counters and gauges (latest value of a quantity, e.g. the leaf size).
+# every stage keeps its last window durations (ms) for rolling percentiles, and a bounded log of
+# (wall time, stage, ms) samples is kept for the csv dump
+class StageMetrics:
+    def __init__(self, window=1000, max_log=100000):
+        self.window = window
+        self.samples = {}
+        self.totals = {}
+        self.counters = {}
+        self.gauges = {}
+        self.log = deque(maxlen=max_log)
+        self.lock = threading.Lock()
+
+    # elapsed: seconds
+    def record(self, stage, elapsed):
+        ms = elapsed * 1000
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.window)
+                self.totals[stage] = 0
+            self.samples[stage].append(ms)
+            self.totals[stage] += 1
+            self.log.append((time.time(), stage, ms))
+
+    # usage: with metrics.timer('downsampling'): ...
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - start)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    # {stage: {'count', 'mean', 'p50', 'p95', 'p99', 'max'}} over the rolling window, in ms.
+    # count is the total number of samples since start
+    def summary(self):
+        with self.lock:
+            samples = {stage: np.array(s) for stage, s in self.samples.items()}
+            totals = dict(self.totals)
+        result = {}
+        for stage, s in samples.items():
+            p50, p95, p99 = np.percentile(s, [50, 95, 99])
+            result[stage] = {'count': totals[stage], 'mean': float(np.mean(s)), 'p50': float(p50),
+                             'p95': float(p95), 'p99': float(p99), 'max': float(np.max(s))}
+        return result
+
+    def summary_string(self):
+        lines = []
+        for stage, s in sorted(self.summary().items()):
+            lines.append('{}: n={} mean={:.2f} p50={:.2f} p95={:.2f} p99={:.2f} max={:.2f} ms'.format(
+                stage, s['count'], s['mean'], s['p50'], s['p95'], s['p99'], s['max']))
+        with self.lock:
+            for name, n in sorted(self.counters.items()):
+                lines.append('{}: {}'.format(name, n))
+            for name, value in sorted(self.gauges.items()):
+                lines.append('{}: {} (latest)'.format(name, value))
+        return '\n'.join(lines)
+
+    # one row per logged sample, followed by one row per counter and gauge (stage column = name, ms column empty,
+    # count column = counter or latest gauge value)
+    def dump_csv(self, path):
+        with self.lock:
+            log = list(self.log)
+            counters = dict(self.counters)
+            counters.update(self.gauges)
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time', 'stage', 'ms', 'count'])
+            for t, stage, ms in log:
+                writer.writerow(['{:.6f}'.format(t), stage, '{:.4f}'.format(ms), ''])
+            for name, n in sorted(counters.items()):
+                writer.writerow(['', name, '', n])
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.totals = {}
+            self.counters = {}
+            self.gauges = {}
+            self.log.clear()
+
+# shared by all stages of a node
+metrics = StageMetrics()
@@ -4,9 +4,17 @@ import cv2
 import numpy as np
 from PIL import Image, ImageFilter
 
-from visualization_msgs.msg import Marker
-from visualization_msgs.msg import MarkerArray
+# only ndarray2MarkerArray needs the ROS messages. the rest of this module is also used offline (benchmarks)
+try:
+    from visualization_msgs.msg import Marker
+    from visualization_msgs.msg import MarkerArray
+except ImportError:
+    Marker = None
+    MarkerArray = None
 from scipy.spatial.transform import Rotation as R
+import time
+
+from stage_metrics import metrics
 
 def pt2pt_dis_sq(pt1, pt2):
     return np.sum(np.square(pt1 - pt2))
@@ -159,6 +167,9 @@ def compute_cost (chain1, chain2, w_e, w_c, mode):
 # paper link: https://ieeexplore.ieee.org/abstract/document/9697357
 def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_length=3, max_curvature=30):  # note: mask is one channel
 
+    # stage timings go to stage_metrics.metrics, the time spent in visualization windows is not counted
+    stage_start = time.time()
+
     # smooth image
     im = Image.fromarray(mask)
     smoothed_im = im.filter(ImageFilter.ModeFilter(size=15))
@@ -166,6 +177,7 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
 
     # resize if necessary for better skeletonization performance
     mask = cv2.resize(mask, (int(mask.shape[1]/img_scale), int(mask.shape[0]/img_scale)))
+    metrics.record('skeleton_smoothing', time.time() - stage_start)
 
     if visualize_process:
         cv2.imshow('init frame', mask)
@@ -175,11 +187,12 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
                 cv2.destroyAllWindows()
                 break
     
+    stage_start = time.time()
     # perform skeletonization
     result = skeletonize(mask, method='zha')
     gray = cv2.cvtColor(result.copy(), cv2.COLOR_BGR2GRAY)
     gray[gray > 100] = 255
-    print('Finished skeletonization. Traversing skeleton contours...')
+    metrics.record('skeleton_skeletonization', time.time() - stage_start)
 
     if visualize_process:
         cv2.imshow('after skeletonization', gray)
@@ -190,6 +203,7 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
                 break
 
     # extract contour
+    stage_start = time.time()
     contours, _ = cv2.findContours(gray, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2:]
 
     chains = []
@@ -258,7 +272,7 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
                 chain = []
                 cur_seg_start_point = None
 
-    print('Finished contour traversal. Pruning extracted chains...')
+    metrics.record('skeleton_traversal', time.time() - stage_start)
 
     if visualize_process:
         mask = np.zeros((gray.shape[0], gray.shape[1], 3), np.uint8)
@@ -274,6 +288,7 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
                 break
 
     # another pruning method
+    stage_start = time.time()
     all_chain_length = []
     line_seg_to_rect_dict = {}
     rect_width = 3
@@ -333,7 +348,7 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
         leftover_chains = np.asarray(leftover_chains, dtype=list)
         sorted_chains = leftover_chains[sorted_idx]
 
-    print('Finished pruning. Merging remaining chains...')
+    metrics.record('skeleton_pruning', time.time() - stage_start)
     
     if visualize_process:
         mask = np.zeros((gray.shape[0], gray.shape[1], 3), np.uint8)
@@ -351,6 +366,8 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
     if len(pruned_chains) == 1:
         return pruned_chains
 
+    stage_start = time.time()
+
     # total number of possible matches = number of ends * (number of ends - 2) / 2 = 2*len(chains) * (len(chains) - 1)
     # cost matrix size: num of tips + 2
     # cost matrix entry label format: tip1 start, tip1 end, tip2 start, tip2 end, ...
@@ -423,7 +440,7 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
             break
         cur_idx = next_idx
     
-    print('Finished merging.')
+    metrics.record('skeleton_merging', time.time() - stage_start)
     
     # visualization code for debug
     if visualize_process:
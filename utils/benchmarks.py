@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import cv2
+import scipy
+
+from tracking_core import register, sort_pts, calc_LLE_weights, track_step, color_thresholding
+from synthetic_dlo import SyntheticDLOScene
+from sweep_scaling import load_trackdlo_utils
+
+# microbenchmarks of the hot python functions on fixed synthetic inputs, no ROS needed.
+# every benchmark reports the median and min wall time of one sample (calls_per_sample calls) over repeats samples.
+# benchmarks whose module cannot be imported (e.g. ndarray2MarkerArray without the ROS messages) or that fail are
+# reported as skipped.
+#
+# usage:
+#   python3 benchmarks.py --output results.json                          # run
+#   python3 benchmarks.py --output baseline.json                         # store a baseline on this machine
+#   python3 benchmarks.py --baseline baseline.json --tolerance 0.2 \
+#                         --tolerance-for cpd_lle=0.3                    # compare, exit code 1 on regressions
+# a benchmark regresses if its median is more than (1 + tolerance) times the baseline median
+
+# name: (function returning the benchmarked callable or None if skipped, calls_per_sample)
+def build_benchmarks (seed=0):
+    scene = SyntheticDLOScene(num_nodes=40, num_pts=1000, motion=0.05, seed=seed)
+    frame_0 = scene.frame(0)
+    frame_1 = scene.frame(1)
+    X_0 = frame_0['points']
+    X_1 = frame_1['points']
+    nodes = frame_0['nodes']
+    rgb, _ = scene.render(0)
+    mask = color_thresholding(rgb, np.full(rgb.shape[0:2], 255, dtype=np.uint8))
+    Y_0, sigma2_0 = register(X_0, 40, 0.05, max_iter=100)
+    Y_0 = sort_pts(Y_0)
+
+    trackdlo_utils = load_trackdlo_utils()
+
+    # two pixel chains with a gap, as produced by the skeleton traversal
+    chain_1 = [(int(u), int(100 + 20*np.sin(u / 30))) for u in range (0, 200, 8)]
+    chain_2 = [(int(u), int(100 + 20*np.sin(u / 30))) for u in range (240, 440, 8)]
+
+    benchmarks = {}
+    benchmarks['register'] = (lambda: lambda: register(X_0, 40, 0.05, max_iter=100), 1)
+    benchmarks['sort_pts'] = (lambda: lambda: sort_pts(Y_0), 10)
+    # k = 6 as in cpd_lle
+    benchmarks['calc_LLE_weights'] = (lambda: lambda: calc_LLE_weights(6, nodes), 10)
+    benchmarks['cpd_lle'] = (lambda: lambda: track_step(X_1, Y_0, sigma2_0), 1)
+
+    def skeleton ():
+        if trackdlo_utils is None:
+            return None
+        mask_bgr = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+        return lambda: trackdlo_utils.extract_connected_skeleton(False, mask_bgr, img_scale=1, seg_length=8, max_curvature=25)
+    benchmarks['extract_connected_skeleton'] = (skeleton, 1)
+
+    def compute_cost ():
+        if trackdlo_utils is None:
+            return None
+        return lambda: [trackdlo_utils.compute_cost(chain_1, chain_2, 1000, 1, mode) for mode in range (0, 4)]
+    benchmarks['compute_cost'] = (compute_cost, 250)
+
+    def check_rect_overlap ():
+        if trackdlo_utils is None:
+            return None
+        Point_2D = trackdlo_utils.Point_2D
+        rect_1 = trackdlo_utils.build_rect(Point_2D(0, 0), Point_2D(10, 1), 3)
+        rect_2 = trackdlo_utils.build_rect(Point_2D(5, -5), Point_2D(6, 5), 3)
+        rect_3 = trackdlo_utils.build_rect(Point_2D(20, 20), Point_2D(30, 21), 3)
+        # one overlapping and one separate pair (the latter checks all edge pairs)
+        return lambda: (trackdlo_utils.check_rect_overlap(rect_1, rect_2), trackdlo_utils.check_rect_overlap(rect_1, rect_3))
+    benchmarks['check_rect_overlap'] = (check_rect_overlap, 1000)
+
+    def marker_array ():
+        if trackdlo_utils is None or trackdlo_utils.MarkerArray is None:
+            return None
+        return lambda: trackdlo_utils.ndarray2MarkerArray(Y_0, 'camera_color_optical_frame', [1, 150/255, 0, 0.75], [0, 1, 0, 0.75])
+    benchmarks['ndarray2MarkerArray'] = (marker_array, 10)
+
+    return benchmarks
+
+def run_benchmark (fn, calls_per_sample, repeats, warmup=1):
+    for _ in range (0, warmup):
+        fn()
+    times = []
+    for _ in range (0, repeats):
+        start = time.perf_counter()
+        for _ in range (0, calls_per_sample):
+            fn()
+        times.append((time.perf_counter() - start) * 1000 / calls_per_sample)
+    return {'median_ms': float(np.median(times)), 'min_ms': float(np.min(times)), 'repeats': repeats, 'calls_per_sample': calls_per_sample}
+
+def run_all (names=None, repeats=10, seed=0):
+    results = {}
+    for name, (build, calls_per_sample) in build_benchmarks(seed).items():
+        if names is not None and name not in names:
+            continue
+        fn = build()
+        if fn is None:
+            results[name] = {'skipped': 'module not available'}
+        else:
+            try:
+                results[name] = run_benchmark(fn, calls_per_sample, repeats)
+            except Exception as e:
+                # e.g. an incompatible version of an optional dependency
+                results[name] = {'skipped': 'failed: ' + repr(e)}
+        print(name + ': ' + json.dumps(results[name]))
+    return {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'platform': platform.platform(),
+                     'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+                     'opencv': cv2.__version__, 'seed': seed, 'repeats': repeats},
+            'results': results}
+
+# returns the list of regressions and prints a comparison table
+def compare (results, baseline, tolerance=0.2, tolerances={}):
+    regressions = []
+    print('{:<28} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline ms', 'current ms', 'ratio'))
+    for name, result in sorted(results['results'].items()):
+        base = baseline['results'].get(name)
+        if 'skipped' in result or base is None or 'skipped' in base:
+            print('{:<28} {:>12} {:>12} {:>8}'.format(name, '-', '-', '-'))
+            continue
+        ratio = result['median_ms'] / base['median_ms']
+        limit = 1 + tolerances.get(name, tolerance)
+        status = ''
+        if ratio > limit:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / limit:
+            status = 'faster'
+        print('{:<28} {:>12.4f} {:>12.4f} {:>8.2f} {}'.format(name, base['median_ms'], result['median_ms'], ratio, status))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the hot python functions, without ROS.')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='baseline json written by a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown of the median')
+    parser.add_argument('--tolerance-for', action='append', default=[], metavar='NAME=TOL', help='per benchmark tolerance')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--only', nargs='+', default=None, help='run only these benchmarks')
+    args = parser.parse_args()
+
+    results = run_all(args.only, args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to ' + args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        tolerances = {}
+        for item in args.tolerance_for:
+            name, tol = item.split('=')
+            tolerances[name] = float(tol)
+        regressions = compare(results, baseline, args.tolerance, tolerances)
+        if len(regressions) != 0:
+            print('regressions: ' + ', '.join(regressions))
+            sys.exit(1)
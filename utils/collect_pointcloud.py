@@ -18,20 +18,26 @@ import time
 import tf
 import csv
 import pickle as pkl
+import message_filters
 from scipy.spatial.transform import Rotation as R
 import os
 from os.path import dirname, abspath, join
 
+from recording import ChunkedRecorder, AsyncSessionWriter
+
 cur_pc = []
+cur_pc_stamp = 0
 cur_image_arr = []
 cur_result = []
 cur_tracking_image_arr = []
+cur_mask = []
 
 # this gives pcl in the camera's frame
 def update_cur_pc(data):
-    global cur_pc
+    global cur_pc, cur_pc_stamp
     pc_arr = ros_numpy.point_cloud2.pointcloud2_to_array(data)
     cur_pc = ros_numpy.point_cloud2.get_xyz_points(pc_arr)
+    cur_pc_stamp = data.header.stamp.to_sec()
 
 def update_cur_result(data):
     global cur_result
@@ -48,66 +54,142 @@ def update_tracking_img(data):
     cur_tracking_image_arr = ros_numpy.numpify(data)
     # cur_tracking_image_arr = cv2.cvtColor(cur_tracking_image, cv2.COLOR_BGR2RGB)
 
-def record(main_dir, start=0, save_image=False, save_results=False):
+def update_mask(data):
+    global cur_mask
+    cur_mask = ros_numpy.numpify(data)[:, :, 0]
+
+# recorder: if set, the samples are appended to this ChunkedRecorder instead of being written as separate files
+def record(main_dir, start=0, save_image=False, save_results=False, recorder=None):
 
     i = start
 
-    while not rospy.is_shutdown():
-        sample_id = ''
-        if len(str(i)) == 1:
-            sample_id = '00' + str(i)
-        else:
-            sample_id = '0' + str(i)
-
-        print("======================================================================")
-        print("Press enter to collect and save point cloud and camera pose data")
-        print("Press q + enter to exit the program")
-        key_pressed = input("sample_id = " + sample_id + "\n")
-
-        if key_pressed == 'q':
-            print("Shutting down... \n")
-            rospy.signal_shutdown('')
-        else:
-            rospy.Subscriber("/camera/color/image_raw", Image, update_img)
-            rospy.Subscriber("/tracking_img", Image, update_tracking_img)
-            rospy.Subscriber("/trackdlo_results_pc", PointCloud2, update_cur_result)
-            rospy.Subscriber("/camera/depth/color/points", PointCloud2, update_cur_pc)
-
-            if save_image:
-                if len(cur_image_arr) == 0:
-                    print(" ")
-                    print("Could not capture image, please try again! \n")
+    # the subscriptions are set up once, the callbacks keep the latest messages
+    rospy.Subscriber("/camera/color/image_raw", Image, update_img)
+    rospy.Subscriber("/tracking_img", Image, update_tracking_img)
+    rospy.Subscriber("/trackdlo_results_pc", PointCloud2, update_cur_result)
+    rospy.Subscriber("/camera/depth/color/points", PointCloud2, update_cur_pc)
+    if recorder is not None:
+        rospy.Subscriber("/mask", Image, update_mask)
+
+    # the buffered frames of the last chunk are written also when the loop ends with ctrl + c
+    try:
+        while not rospy.is_shutdown():
+            sample_id = ''
+            if len(str(i)) == 1:
+                sample_id = '00' + str(i)
+            else:
+                sample_id = '0' + str(i)
+
+            print("======================================================================")
+            print("Press enter to collect and save point cloud and camera pose data")
+            print("Press q + enter to exit the program")
+            key_pressed = input("sample_id = " + sample_id + "\n")
+
+            if key_pressed == 'q':
+                print("Shutting down... \n")
+                rospy.signal_shutdown('')
+            else:
+                if recorder is not None:
+                    if len(cur_pc) == 0 or (save_image and len(cur_image_arr) == 0) or (save_results and (len(cur_result) == 0 or len(cur_tracking_image_arr) == 0)):
+                        print(" ")
+                        print("Could not capture all data, please try again! \n")
+                        continue
+
+                    # images are stored in RGB order
+                    frame = {'stamp': np.float64(cur_pc_stamp),
+                             'points': np.asarray(cur_pc, dtype=np.float32)}
+                    if save_image:
+                        frame['rgb'] = cv2.cvtColor(cur_image_arr, cv2.COLOR_BGR2RGB)
+                        frame['mask'] = cur_mask if len(cur_mask) != 0 else np.zeros(cur_image_arr.shape[0:2], dtype=np.uint8)
+                    if save_results:
+                        frame['results'] = np.asarray(cur_result, dtype=np.float32)
+                        frame['tracking_img'] = cur_tracking_image_arr
+                    recorder.append(frame)
+
+                    print("Data saved successfully! \n")
+                    i += 1
                     continue
-                cv2.imwrite(main_dir + sample_id + "_rgb.png", cur_image_arr)
+
+                if save_image:
+                    if len(cur_image_arr) == 0:
+                        print(" ")
+                        print("Could not capture image, please try again! \n")
+                        continue
+                    cv2.imwrite(main_dir + sample_id + "_rgb.png", cur_image_arr)
             
-            if save_results:
-                if len(cur_result) == 0:
+                if save_results:
+                    if len(cur_result) == 0:
+                        print(" ")
+                        print("Could not capture results, please try again! \n")
+                        continue
+
+                    f = open(main_dir + sample_id + "_results.json", "wb")
+                    pkl.dump(cur_result, f)
+                    f.close()
+
+                    if len(cur_tracking_image_arr) == 0:
+                        print(" ")
+                        print("Could not capture tracking image, please try again! \n")
+                        continue
+                    cv2.imwrite(main_dir + sample_id + "_result.png", cur_tracking_image_arr)
+
+                # sometimes pointcloud can be empty
+                if len(cur_pc) == 0:
                     print(" ")
-                    print("Could not capture results, please try again! \n")
+                    print("Could not capture point cloud, please try again! \n")
                     continue
 
-                f = open(main_dir + sample_id + "_results.json", "wb")
-                pkl.dump(cur_result, f)
+                f = open(main_dir + sample_id + "_pc.json", "wb")
+                pkl.dump(cur_pc, f)
                 f.close()
 
-                if len(cur_tracking_image_arr) == 0:
-                    print(" ")
-                    print("Could not capture tracking image, please try again! \n")
-                    continue
-                cv2.imwrite(main_dir + sample_id + "_result.png", cur_tracking_image_arr)
-
-            # sometimes pointcloud can be empty
-            if len(cur_pc) == 0:
-                print(" ")
-                print("Could not capture point cloud, please try again! \n")
-                continue
-
-            f = open(main_dir + sample_id + "_pc.json", "wb")
-            pkl.dump(cur_pc, f)
-            f.close()
-
-            print("Data saved successfully! \n")
-            i += 1
+                print("Data saved successfully! \n")
+                i += 1
+    finally:
+        if recorder is not None:
+            recorder.close()
+
+# continuous capture of every synchronized camera frame (rgb + point cloud) into recorder, until shutdown.
+# the callback only queues the messages, the conversion and writing happen in the writer thread. the tracker outputs
+# (mask, results, tracking image) are rate limited and not stamped like the camera, so the latest ones are attached.
+# block_timeout: how long (s) the callback waits for a full queue before the frame is dropped
+def capture(recorder, save_results=False, max_queue=60, block_timeout=0.0, slop=0.02, stats_period=5.0):
+    rospy.Subscriber("/mask", Image, update_mask)
+    if save_results:
+        rospy.Subscriber("/tracking_img", Image, update_tracking_img)
+        rospy.Subscriber("/trackdlo_results_pc", PointCloud2, update_cur_result)
+
+    # images are stored in RGB order
+    def encode(item):
+        rgb, pc, mask, result, tracking_image = item
+        pc_arr = ros_numpy.point_cloud2.pointcloud2_to_array(pc)
+        frame = {'stamp': np.float64(pc.header.stamp.to_sec()),
+                 'rgb': ros_numpy.numpify(rgb),
+                 'points': np.asarray(ros_numpy.point_cloud2.get_xyz_points(pc_arr), dtype=np.float32)}
+        frame['mask'] = mask if len(mask) != 0 else np.zeros(frame['rgb'].shape[0:2], dtype=np.uint8)
+        if save_results:
+            if len(result) == 0 or len(tracking_image) == 0:
+                return None
+            frame['results'] = np.asarray(result, dtype=np.float32)
+            frame['tracking_img'] = tracking_image
+        return frame
+
+    writer = AsyncSessionWriter(recorder, encode, max_queue=max_queue, block_timeout=block_timeout)
+
+    def callback(rgb, pc):
+        writer.put((rgb, pc, cur_mask, cur_result, cur_tracking_image_arr))
+
+    rgb_sub = message_filters.Subscriber("/camera/color/image_raw", Image, queue_size=10)
+    pc_sub = message_filters.Subscriber("/camera/depth/color/points", PointCloud2, queue_size=10)
+    ts = message_filters.ApproximateTimeSynchronizer([rgb_sub, pc_sub], 10, slop)
+    ts.registerCallback(callback)
+
+    rospy.Timer(rospy.Duration(stats_period), lambda event: print("Capture: " + writer.stats_string()))
+    print("Capturing, press ctrl + c to stop \n")
+    rospy.spin()
+
+    writer.close()
+    print("Capture finished: " + writer.stats_string() + "\n")
 
 if __name__ == '__main__':
     rospy.init_node('record_data', anonymous=True)
@@ -120,7 +202,22 @@ if __name__ == '__main__':
     print(main_dir)
     print("###################################################################### \n")
 
-    record(main_dir, start=0, save_image=True, save_results=True)
+    # append the samples to a chunked array archive (see recording.py) instead of writing pickle and png files
+    use_chunked_recording = False
+    # record every camera frame (about 30 Hz) until ctrl + c instead of one sample per enter, needs chunked recording
+    use_continuous_capture = False
+    # compressed chunks are smaller, but the compression does not keep up with continuous capture at 30 Hz
+    compress_recording = not use_continuous_capture
+    recorder = None
+    if use_chunked_recording or use_continuous_capture:
+        session_dir = join(main_dir, 'session_' + time.strftime('%Y%m%d_%H%M%S'))
+        recorder = ChunkedRecorder(session_dir, chunk_size=50, compress=compress_recording, ragged=('points', 'results'))
+        print("Recording session: " + session_dir + "\n")
+
+    if use_continuous_capture:
+        capture(recorder, save_results=False)
+    else:
+        record(main_dir, start=0, save_image=True, save_results=True, recorder=recorder)
     # except:
     # 	print("Invalid directory!")
     # 	rospy.signal_shutdown('')
\ No newline at end of file
@@ -0,0 +1,339 @@
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+# chunked columnar recording format for collected frames.
+#
+# a session is a directory with an index.json and one chunk per chunk_size frames:
+#   index.json           {'version', 'fields': {name: {'dtype', 'shape', 'ragged'}}, 'chunks': [{'name', 'num_frames', 'compressed'}]}
+#   chunk_00000/<name>.npy                     uncompressed chunk, one (num_frames, *shape) array per field
+#   chunk_00000.npz                            compressed chunk (np.savez_compressed), same arrays
+# ragged fields (e.g. unorganized point clouds) have a variable first dimension. they are stored as the concatenated
+# frames in <name>.npy plus <name>_offsets.npy (num_frames + 1 start offsets)
+#
+# the uncompressed chunks can be memory-mapped (see FrameDataset), the compressed ones take less disk space
+
+index_name = 'index.json'
+
+def chunk_name (i):
+    return 'chunk_{:05d}'.format(i)
+
+class ChunkedRecorder:
+    # ragged: names of the fields with a variable first dimension
+    def __init__(self, session_dir, chunk_size=100, compress=False, ragged=()):
+        self.session_dir = session_dir
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.ragged = set(ragged)
+        self.fields = None
+        self.chunks = []
+        self.buffer = []
+        self.num_frames = 0
+        if not os.path.isdir(session_dir):
+            os.makedirs(session_dir)
+
+    # frame: {name: array}. the first frame defines the fields, later frames must have the same fields, dtypes and
+    # (except for ragged fields) shapes
+    def append(self, frame):
+        frame = {name: np.asarray(value) for name, value in frame.items()}
+        if self.fields is None:
+            self.fields = {}
+            for name, value in frame.items():
+                ragged = name in self.ragged
+                shape = list(value.shape[1:]) if ragged else list(value.shape)
+                self.fields[name] = {'dtype': value.dtype.str, 'shape': shape, 'ragged': ragged}
+        if set(frame.keys()) != set(self.fields.keys()):
+            raise ValueError('frame fields ' + str(sorted(frame.keys())) + ' do not match ' + str(sorted(self.fields.keys())))
+        for name, value in frame.items():
+            field = self.fields[name]
+            shape = list(value.shape[1:]) if field['ragged'] else list(value.shape)
+            if shape != field['shape']:
+                raise ValueError('field ' + name + ' has shape ' + str(value.shape) + ', expected ' + str(field['shape']))
+
+        self.buffer.append(frame)
+        self.num_frames += 1
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        arrays = {}
+        for name, field in self.fields.items():
+            dtype = np.dtype(field['dtype'])
+            values = [frame[name] for frame in self.buffer]
+            if field['ragged']:
+                lengths = [len(value) for value in values]
+                arrays[name + '_offsets'] = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+                arrays[name] = np.concatenate(values).astype(dtype, copy=False).reshape([-1] + field['shape'])
+            else:
+                arrays[name] = np.stack(values).astype(dtype, copy=False)
+
+        name = chunk_name(len(self.chunks))
+        if self.compress:
+            np.savez_compressed(os.path.join(self.session_dir, name + '.npz'), **arrays)
+        else:
+            chunk_dir = os.path.join(self.session_dir, name)
+            if not os.path.isdir(chunk_dir):
+                os.makedirs(chunk_dir)
+            for array_name, array in arrays.items():
+                np.save(os.path.join(chunk_dir, array_name + '.npy'), array)
+
+        self.chunks.append({'name': name, 'num_frames': len(self.buffer), 'compressed': self.compress})
+        self.buffer = []
+        self.write_index()
+
+    # the index is replaced atomically, so a reader never sees a chunk that is not completely written
+    def write_index(self):
+        index = {'version': 1, 'chunk_size': self.chunk_size, 'fields': self.fields, 'chunks': self.chunks}
+        tmp_path = os.path.join(self.session_dir, index_name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_path, os.path.join(self.session_dir, index_name))
+
+    def close(self):
+        self.flush()
+
+# reads every page of an array (one element per 4 KB), so that a memory-mapped view is in the page cache before use
+def touch_pages (array):
+    if isinstance(array, np.memmap) or (isinstance(array, np.ndarray) and isinstance(array.base, np.memmap)):
+        flat = array.reshape(-1)
+        step = max(4096 // max(flat.itemsize, 1), 1)
+        flat[::step].sum()
+
+# random access reader of a ChunkedRecorder session.
+# uncompressed chunks are memory-mapped and frames are views into them (no copy, read-only), compressed chunks are
+# decompressed on first access and the last cache_chunks of them are kept.
+# dataset[i] gives one frame {name: array}, dataset[a:b] a list of frames, len(dataset) the number of frames
+class FrameDataset:
+    # fields: names of the fields to load (default all)
+    def __init__(self, session_dir, fields=None, cache_chunks=2):
+        self.session_dir = session_dir
+        with open(os.path.join(session_dir, index_name)) as f:
+            index = json.load(f)
+        self.fields = index['fields']
+        if fields is not None:
+            self.fields = {name: self.fields[name] for name in fields}
+        self.chunks = index['chunks']
+        self.chunk_starts = np.concatenate(([0], np.cumsum([chunk['num_frames'] for chunk in self.chunks]))).astype(np.int64)
+        self.cache_chunks = cache_chunks
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.stamps = None
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    def array_names(self):
+        names = []
+        for name, field in self.fields.items():
+            names.append(name)
+            if field['ragged']:
+                names.append(name + '_offsets')
+        return names
+
+    def load_chunk(self, c):
+        with self.cache_lock:
+            if c in self.cache:
+                self.cache.move_to_end(c)
+                return self.cache[c]
+        chunk = self.chunks[c]
+        if chunk['compressed']:
+            with np.load(os.path.join(self.session_dir, chunk['name'] + '.npz')) as archive:
+                arrays = {name: archive[name] for name in self.array_names()}
+        else:
+            chunk_dir = os.path.join(self.session_dir, chunk['name'])
+            arrays = {name: np.load(os.path.join(chunk_dir, name + '.npy'), mmap_mode='r') for name in self.array_names()}
+        with self.cache_lock:
+            self.cache[c] = arrays
+            # memory maps cost no memory until they are read, only the decompressed chunks are evicted
+            compressed = [key for key in self.cache.keys() if self.chunks[key]['compressed']]
+            for key in compressed[0:max(len(compressed) - self.cache_chunks, 0)]:
+                del self.cache[key]
+        return arrays
+
+    def frame(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('frame ' + str(i) + ' out of range (' + str(len(self)) + ' frames)')
+        c = int(np.searchsorted(self.chunk_starts, i, side='right')) - 1
+        j = i - int(self.chunk_starts[c])
+        arrays = self.load_chunk(c)
+        frame = {}
+        for name, field in self.fields.items():
+            if field['ragged']:
+                offsets = arrays[name + '_offsets']
+                frame[name] = arrays[name][offsets[j]:offsets[j+1]]
+            else:
+                frame[name] = arrays[name][j]
+        return frame
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.frame(i) for i in range (*key.indices(len(self)))]
+        return self.frame(int(key))
+
+    def __iter__(self):
+        return self.iterate()
+
+    # stamps of all frames, needs a 'stamp' field
+    def all_stamps(self):
+        if self.stamps is None:
+            if 'stamp' not in self.fields:
+                raise KeyError('the session has no stamp field')
+            self.stamps = np.concatenate([np.asarray(self.load_chunk(c)['stamp']) for c in range (0, len(self.chunks))])
+        return self.stamps
+
+    # index of the first frame with a stamp >= stamp (the stamps are increasing)
+    def index_of_stamp(self, stamp):
+        return int(np.searchsorted(self.all_stamps(), stamp, side='left'))
+
+    # slice of the frames with start <= stamp < end
+    def stamp_slice(self, start, end):
+        return slice(self.index_of_stamp(start), self.index_of_stamp(end))
+
+    # contiguous block of the frame indices for worker i of num_workers. every worker opens its own FrameDataset,
+    # the memory maps share the page cache, so the data is not copied between processes
+    def shard(self, i, num_workers):
+        bounds = np.linspace(0, len(self), num_workers + 1).astype(np.int64)
+        return range (int(bounds[i]), int(bounds[i+1]))
+
+    # iterates over the frames (default all), a background thread loads up to prefetch frames ahead
+    # (decompresses chunks or reads the pages of the memory-mapped views)
+    def iterate(self, indices=None, prefetch=4):
+        if indices is None:
+            indices = range (0, len(self))
+        if isinstance(indices, slice):
+            indices = range (*indices.indices(len(self)))
+        if prefetch <= 0:
+            for i in indices:
+                yield self.frame(i)
+            return
+
+        frames = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        done = object()
+
+        # returns False if the consumer stopped iterating
+        def put(item):
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def load():
+            try:
+                for i in indices:
+                    frame = self.frame(i)
+                    for array in frame.values():
+                        touch_pages(array)
+                    if not put(frame):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        try:
+            while True:
+                frame = frames.get()
+                if frame is done:
+                    break
+                if isinstance(frame, Exception):
+                    raise frame
+                yield frame
+        finally:
+            stop.set()
+            thread.join()
+
+# writes frames to a ChunkedRecorder from a background thread, so that the caller (e.g. a ROS callback) does not
+# wait for the encoding and the disk. the frames go through a queue of at most max_queue frames. if it is full, put
+# waits up to block_timeout (s) for the writer (back-pressure) and then drops the frame.
+# encode: optional function applied to each item in the writer thread (e.g. ROS messages -> {name: array}),
+# returning None skips the item
+class AsyncSessionWriter:
+    def __init__(self, recorder, encode=None, max_queue=60, block_timeout=0.0):
+        self.recorder = recorder
+        self.encode = encode
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.stats = {'received': 0, 'written': 0, 'dropped': 0, 'skipped': 0, 'failed': 0, 'max_queue': 0, 'write_time': 0.0}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.closed = False
+        self.thread.start()
+
+    # returns False if the frame was dropped
+    def put(self, item):
+        with self.lock:
+            self.stats['received'] += 1
+        if self.closed:
+            with self.lock:
+                self.stats['dropped'] += 1
+            return False
+        try:
+            if self.block_timeout > 0:
+                self.queue.put(item, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.stats['dropped'] += 1
+            return False
+        with self.lock:
+            self.stats['max_queue'] = max(self.stats['max_queue'], self.queue.qsize())
+        return True
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            start = time.time()
+            try:
+                frame = item if self.encode is None else self.encode(item)
+                if frame is None:
+                    with self.lock:
+                        self.stats['skipped'] += 1
+                    continue
+                self.recorder.append(frame)
+            except Exception as e:
+                print('AsyncSessionWriter: failed to write a frame: ' + repr(e))
+                with self.lock:
+                    self.stats['failed'] += 1
+                continue
+            with self.lock:
+                self.stats['written'] += 1
+                self.stats['write_time'] += time.time() - start
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+    def stats_string(self):
+        stats = self.get_stats()
+        mean_ms = 1000 * stats['write_time'] / max(stats['written'], 1)
+        return 'received {} written {} dropped {} skipped {} failed {} queued {} (max {}), {:.1f} ms per frame'.format(
+            stats['received'], stats['written'], stats['dropped'], stats['skipped'], stats['failed'],
+            stats['queued'], stats['max_queue'], mean_ms)
+
+    # writes the queued frames and the last chunk
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.recorder.close()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import os
+import sys
+import pickle as pkl
+import time
+from os.path import dirname, abspath, join
+
+import cv2
+import numpy as np
+
+from tracking_core import extract_masked_xyz_from_depth, color_thresholding, filter_and_downsample, \
+                          LeafSizeController, NodePredictor, StaticSceneDetector, \
+                          geodesic_coordinates, initialize_nodes, track_step
+from visibility import project_nodes, node_visibility, visibility_weights
+from recording import index_name, FrameDataset
+
+# shared with the package's python nodes
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'trackdlo/src'))
+from stage_metrics import metrics
+
+# offline replay of recorded frames through the preprocessing and cpd_lle path of tracking_test.py, without ROS.
+# frames are processed back to back and nothing depends on wall-clock time, so runs are repeatable
+# (except with --frame-period, which enables the EM deadline).
+#
+# supported recordings:
+#   a directory written by collect_pointcloud.py: NNN_rgb.png + NNN_pc.json (pickled N*3 camera frame points)
+#   a session written by collect_pointcloud.py with use_chunked_recording (see recording.py)
+#   an .npz archive with rgb (T*H*W*3, RGB order) and either xyz (T*H*W*3, organized point clouds) or
+#   depth (T*H*W, uint16 mm or float m) + proj_matrix (3*4). optional: stamps (T, seconds), proj_matrix with xyz, occlusion (T*H*W, 0 = occluded)
+#
+# usage: python3 replay_tracking.py <recording> [--output trajectories.npz] [--metrics-csv stages.csv]
+
+proj_matrix = np.array([[918.359130859375,              0.0, 645.8908081054688, 0.0], \
+                        [             0.0, 916.265869140625,   354.02392578125, 0.0], \
+                        [             0.0,              0.0,               1.0, 0.0]])
+
+# frames of a collect_pointcloud.py directory. the saved point clouds are unorganized, so the points are
+# matched to the mask by projecting them into the image
+def load_sample_dir (main_dir, frame_rate=30.0):
+    pc_files = sorted(glob.glob(os.path.join(main_dir, '*_pc.json')))
+    for i, pc_file in enumerate(pc_files):
+        sample_id = os.path.basename(pc_file)[:-len('_pc.json')]
+        rgb_file = os.path.join(main_dir, sample_id + '_rgb.png')
+        if not os.path.isfile(rgb_file):
+            print('skipping ' + sample_id + ': no rgb image')
+            continue
+        with open(pc_file, 'rb') as f:
+            points = np.asarray(pkl.load(f), dtype=np.float32)
+        # the images are written in BGR order
+        rgb = cv2.cvtColor(cv2.imread(rgb_file), cv2.COLOR_BGR2RGB)
+        yield {'stamp': i / frame_rate, 'rgb': rgb, 'points': points, 'proj_matrix': proj_matrix}
+
+def load_archive (path, frame_rate=30.0):
+    archive = np.load(path)
+    num_frames = len(archive['rgb'])
+    for i in range (0, num_frames):
+        frame = {'stamp': archive['stamps'][i] if 'stamps' in archive else i / frame_rate,
+                 'rgb': archive['rgb'][i]}
+        # the archive's own intrinsics, if it has them, are used for the projections of every frame
+        frame['proj_matrix'] = archive['proj_matrix'] if 'proj_matrix' in archive else proj_matrix
+        if 'xyz' in archive:
+            frame['xyz'] = archive['xyz'][i]
+        else:
+            frame['depth'] = archive['depth'][i]
+        if 'occlusion' in archive:
+            frame['occlusion'] = archive['occlusion'][i]
+        yield frame
+
+# frames of a ChunkedRecorder session, as views into the memory-mapped chunks
+def load_session (session_dir, prefetch=4):
+    fields = [name for name in ['stamp', 'rgb', 'points', 'xyz', 'depth'] if name in FrameDataset(session_dir).fields]
+    dataset = FrameDataset(session_dir, fields=fields)
+    for frame in dataset.iterate(prefetch=prefetch):
+        frame['stamp'] = float(frame['stamp'])
+        frame['proj_matrix'] = proj_matrix
+        yield frame
+
+# points (N*3) whose projection falls on a nonzero mask pixel
+def select_masked_points (points, mask, proj_matrix):
+    points = points[points[:, 2] > 0]
+    us, vs = project_nodes(points, proj_matrix)
+    inside = (us >= 0) & (us < mask.shape[1]) & (vs >= 0) & (vs < mask.shape[0])
+    points = points[inside]
+    return points[mask[vs[inside], us[inside]] != 0]
+
+def replay (frames, use_eval_rope=True, leaf_size=0.005, use_adaptive_leaf_size=False, use_visibility=False,
+            use_motion_prediction=False, carry_sigma2=False, use_squarem=False, kernel_rank=None, frame_period=None,
+            use_static_detection=False):
+    leaf_size_controller = LeafSizeController(target_num_pts=400, leaf_size=leaf_size)
+    node_predictor = NodePredictor()
+    static_detector = StaticSceneDetector()
+    nodes = None
+    sigma2 = 0
+    geodesic_coord = None
+
+    stamps = []
+    trajectory = []
+    sigma2s = []
+    iterations = []
+    num_pts = []
+    processing_time = 0
+
+    for frame in frames:
+        frame_start = time.time()
+        rgb = frame['rgb']
+        # intrinsics of the recording, for every projection and back-projection of this frame
+        frame_proj_matrix = frame.get('proj_matrix', proj_matrix)
+
+        with metrics.timer('thresholding'):
+            occlusion_mask = frame.get('occlusion')
+            if occlusion_mask is None:
+                occlusion_mask = np.full(rgb.shape[0:2], 255, dtype=np.uint8)
+            bmask = color_thresholding(rgb, occlusion_mask, use_eval_rope)
+
+        with metrics.timer('extraction'):
+            if 'xyz' in frame:
+                filtered_pc = frame['xyz'].reshape(-1, 3)[np.flatnonzero(bmask)].astype(np.float32)
+                filtered_pc = filtered_pc[np.isfinite(filtered_pc[:, 2])]
+            elif 'depth' in frame:
+                filtered_pc = extract_masked_xyz_from_depth(frame['depth'], bmask, frame_proj_matrix)
+            else:
+                filtered_pc = select_masked_points(frame['points'], bmask, frame_proj_matrix)
+
+        cur_leaf_size = leaf_size_controller.leaf_size if use_adaptive_leaf_size else leaf_size
+        with metrics.timer('downsampling'):
+            filtered_pc = filter_and_downsample(filtered_pc, cur_leaf_size)
+        metrics.gauge('leaf_size', cur_leaf_size)
+        metrics.gauge('downsampled_points', len(filtered_pc))
+        if use_adaptive_leaf_size:
+            leaf_size_controller.update(len(filtered_pc))
+
+        if len(filtered_pc) == 0:
+            metrics.count('empty_frames')
+            continue
+
+        if nodes is None:
+            with metrics.timer('initialization'):
+                nodes, sigma2 = initialize_nodes(filtered_pc, 40, 0.05, max_iter=100)
+                geodesic_coord = geodesic_coordinates(nodes)
+
+        if use_static_detection and static_detector.is_static(bmask, filtered_pc):
+            em_info = {'converged': True, 'iterations': 0, 'error': 0.0, 'timed_out': False}
+            node_predictor.add(frame['stamp'], nodes)
+            metrics.count('static_frames_skipped')
+        else:
+            node_weights = None
+            pt_weights = None
+            if use_visibility:
+                with metrics.timer('visibility'):
+                    visible_nodes, node_pt_dists, pt_node_dists = node_visibility(nodes, filtered_pc, frame_proj_matrix, geodesic_coord=geodesic_coord)
+                    if len(visible_nodes) != len(nodes) and len(visible_nodes) != 0:
+                        node_weights, pt_weights = visibility_weights(node_pt_dists, pt_node_dists, visible_nodes=visible_nodes)
+
+            if use_motion_prediction and len(node_predictor.history) != 0:
+                Y_0 = node_predictor.predict(frame['stamp'])
+            else:
+                Y_0 = nodes
+            deadline = None
+            if frame_period is not None:
+                deadline = frame_start + frame_period
+
+            with metrics.timer('cpd_lle'):
+                nodes, sigma2, em_info = track_step(filtered_pc, Y_0, sigma2, carry_sigma2, use_squarem=use_squarem, deadline=deadline, kernel_rank=kernel_rank, node_weights=node_weights, pt_weights=pt_weights)
+            node_predictor.add(frame['stamp'], nodes)
+            if use_static_detection:
+                static_detector.set_reference(bmask, filtered_pc)
+
+        frame_time = time.time() - frame_start
+        metrics.record('frame', frame_time)
+        processing_time += frame_time
+
+        stamps.append(frame['stamp'])
+        trajectory.append(nodes.copy())
+        sigma2s.append(sigma2)
+        iterations.append(em_info['iterations'])
+        num_pts.append(len(filtered_pc))
+
+    return {'stamps': np.array(stamps),
+            'nodes': np.array(trajectory),
+            'sigma2': np.array(sigma2s),
+            'iterations': np.array(iterations),
+            'num_pts': np.array(num_pts),
+            'processing_time': processing_time}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded frames through the python tracker without ROS.')
+    parser.add_argument('recording', help='collect_pointcloud.py directory or session, or .npz archive')
+    parser.add_argument('--output', default=None, help='write the node trajectories to this .npz file')
+    parser.add_argument('--metrics-csv', default=None, help='write the per-stage timings to this csv file')
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--single-color', action='store_true', help='single color thresholding (use_eval_rope = False)')
+    parser.add_argument('--leaf-size', type=float, default=0.005)
+    parser.add_argument('--adaptive-leaf-size', action='store_true')
+    parser.add_argument('--visibility', action='store_true')
+    parser.add_argument('--motion-prediction', action='store_true')
+    parser.add_argument('--carry-sigma2', action='store_true')
+    parser.add_argument('--squarem', action='store_true')
+    parser.add_argument('--static-detection', action='store_true', help='skip registration on unchanged frames')
+    parser.add_argument('--kernel-rank', type=int, default=None)
+    parser.add_argument('--frame-period', type=float, default=None, help='EM deadline per frame (s), makes runs timing dependent')
+    args = parser.parse_args()
+
+    if os.path.isfile(os.path.join(args.recording, index_name)):
+        frames = load_session(args.recording)
+    elif os.path.isdir(args.recording):
+        frames = load_sample_dir(args.recording)
+    else:
+        frames = load_archive(args.recording)
+    if args.max_frames is not None:
+        frames = (frame for i, frame in zip(range (0, args.max_frames), frames))
+
+    result = replay(frames, use_eval_rope=not args.single_color, leaf_size=args.leaf_size,
+                    use_adaptive_leaf_size=args.adaptive_leaf_size, use_visibility=args.visibility,
+                    use_motion_prediction=args.motion_prediction, carry_sigma2=args.carry_sigma2,
+                    use_squarem=args.squarem, kernel_rank=args.kernel_rank, frame_period=args.frame_period,
+                    use_static_detection=args.static_detection)
+
+    num_frames = len(result['stamps'])
+    print('frames: ' + str(num_frames))
+    if num_frames != 0:
+        print('frames/s (processing only): {:.2f}'.format(num_frames / result['processing_time']))
+        print('mean EM iterations: {:.2f}, mean points: {:.1f}'.format(np.mean(result['iterations']), np.mean(result['num_pts'])))
+    print(metrics.summary_string())
+
+    if args.output is not None:
+        np.savez(args.output, stamps=result['stamps'], nodes=result['nodes'], sigma2=result['sigma2'],
+                 iterations=result['iterations'], num_pts=result['num_pts'])
+        print('trajectories written to ' + args.output)
+    if args.metrics_csv is not None:
+        metrics.dump_csv(args.metrics_csv)
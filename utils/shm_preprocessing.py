@@ -0,0 +1,154 @@
+import numpy as np
+import multiprocessing as mp
+import threading
+import queue
+from multiprocessing import shared_memory
+
+# fixed size frame buffers in shared memory, one ring of num_slots slots per array.
+# spec: {name: (shape, dtype)} for a single slot
+# the ring is pickled by the names of its shared memory blocks, the worker processes attach to the same blocks,
+# so frames never go through a pipe
+class SharedFrameRing:
+    def __init__(self, spec, num_slots):
+        self.spec = spec
+        self.num_slots = num_slots
+        self.shms = {}
+        self.arrays = {}
+        for name, (shape, dtype) in spec.items():
+            shape = (num_slots,) + tuple(shape)
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            self.shms[name] = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.map_arrays()
+
+    def map_arrays(self):
+        for name, (shape, dtype) in self.spec.items():
+            self.arrays[name] = np.ndarray((self.num_slots,) + tuple(shape), dtype=dtype, buffer=self.shms[name].buf)
+
+    def __getstate__(self):
+        return {'spec': self.spec, 'num_slots': self.num_slots, 'names': {name: shm.name for name, shm in self.shms.items()}}
+
+    def __setstate__(self, state):
+        self.spec = state['spec']
+        self.num_slots = state['num_slots']
+        self.shms = {name: shared_memory.SharedMemory(name=shm_name) for name, shm_name in state['names'].items()}
+        self.arrays = {}
+        self.map_arrays()
+
+    # views of every array for one slot, nothing is copied
+    def slot(self, i):
+        return {name: array[i] for name, array in self.arrays.items()}
+
+    def close(self, unlink=True):
+        # the numpy views have to be released before the shared memory can be closed
+        self.arrays = {}
+        for shm in self.shms.values():
+            shm.close()
+            if unlink:
+                shm.unlink()
+        self.shms = {}
+
+# worker process: process_fn(views, meta) reads the input arrays of a slot, writes the output arrays of the same slot
+# and returns a small result (e.g. the number of points). only (slot, meta, result) is sent back
+def worker_loop (ring, process_fn, work_queue, result_queue):
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        slot, meta = item
+        try:
+            result = process_fn(ring.slot(slot), meta)
+        except Exception as e:
+            print('preprocessing worker failed on slot ' + str(slot) + ': ' + repr(e))
+            result = None
+        result_queue.put((slot, meta, result))
+
+# runs process_fn in num_workers processes on the slots of a SharedFrameRing.
+# usage (main process): slot = acquire(); fill ring.slot(slot) inputs; submit(slot, meta)
+# on_result(views, meta, result) is called in the collector thread, in submission order. it must copy what it needs,
+# the slot is reused as soon as it returns. if process_fn failed, on_failure(meta) is called instead.
+# if every slot is in use, acquire returns None and the frame is dropped.
+# the workers are spawned, not forked: forking a process with running threads (rospy, cv2) can copy a held lock
+# into the child. process_fn has to be importable (a module level function) and the workers import its module.
+# start them before the subscribers are registered, spawning takes a moment
+class ParallelPreprocessor:
+    def __init__(self, ring, process_fn, on_result, num_workers=2, on_failure=None):
+        self.ring = ring
+        self.process_fn = process_fn
+        self.on_result = on_result
+        self.on_failure = on_failure
+        self.num_workers = num_workers
+
+        self.free_slots = queue.Queue()
+        for i in range (0, ring.num_slots):
+            self.free_slots.put(i)
+
+        ctx = mp.get_context('spawn')
+        self.work_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.workers = [ctx.Process(target=worker_loop, args=(ring, process_fn, self.work_queue, self.result_queue))
+                        for _ in range (0, num_workers)]
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+
+        self.seq = 0
+        self.num_submitted = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+
+    def start(self):
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        self.collector.start()
+
+    # returns a free slot index, or None (frame dropped) if all slots are in use
+    def acquire(self):
+        try:
+            return self.free_slots.get_nowait()
+        except queue.Empty:
+            self.num_dropped += 1
+            return None
+
+    # gives back a slot that was acquired but not submitted
+    def release(self, slot):
+        self.free_slots.put(slot)
+
+    def submit(self, slot, meta):
+        meta['seq'] = self.seq
+        self.seq += 1
+        self.num_submitted += 1
+        self.work_queue.put((slot, meta))
+
+    def collect(self):
+        # workers can finish out of order. results are held back until all earlier ones have arrived
+        pending = {}
+        next_seq = 0
+        while True:
+            item = self.result_queue.get()
+            if item is None:
+                break
+            slot, meta, result = item
+            pending[meta['seq']] = item
+            while next_seq in pending:
+                slot, meta, result = pending.pop(next_seq)
+                next_seq += 1
+                try:
+                    if result is None:
+                        self.num_failed += 1
+                        if self.on_failure is not None:
+                            self.on_failure(meta)
+                    else:
+                        self.on_result(self.ring.slot(slot), meta, result)
+                finally:
+                    self.free_slots.put(slot)
+
+    def shutdown(self):
+        for _ in self.workers:
+            self.work_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
+        self.result_queue.put(None)
+        self.collector.join(timeout=1.0)
+        self.ring.close()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib.util
+import json
+import time
+import sys
+from os.path import dirname, abspath, join
+
+import numpy as np
+
+from tracking_core import register, sort_pts, track_step
+from synthetic_dlo import SyntheticDLOScene
+
+# scaling sweep of the python registration code on synthetic scenes (no ROS needed):
+#   register, sort_pts and cpd_lle against the number of points N (M fixed) and the number of nodes M (N fixed),
+#   extract_connected_skeleton against the DLO length in the rendered image (its input is an image, not N or M)
+# writes the timings as json and, if matplotlib is available, a chart
+#
+# usage: python3 sweep_scaling.py [--output sweep.json] [--chart sweep.png] [--repeats 5]
+
+# trackdlo/src/utils.py (a different module than this directory) needs skimage, PIL and the ROS message packages.
+# returns None if it cannot be imported
+def load_trackdlo_utils ():
+    src_dir = join(dirname(dirname(abspath(__file__))), 'trackdlo/src')
+    if src_dir not in sys.path:
+        sys.path.append(src_dir)
+    try:
+        spec = importlib.util.spec_from_file_location('trackdlo_utils', join(src_dir, 'utils.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except Exception as e:
+        print('extract_connected_skeleton is skipped: ' + repr(e))
+        return None
+
+# median wall time (ms) of fn() over repeats runs, and the result of the last run
+def time_call (fn, repeats):
+    times = []
+    for _ in range (0, repeats):
+        start = time.time()
+        result = fn()
+        times.append((time.time() - start) * 1000)
+    return float(np.median(times)), result
+
+def sweep_registration (Ns, Ms, M_fixed=40, N_fixed=1000, repeats=5, seed=0):
+    rows = []
+    configs = [(N, M_fixed, 'N') for N in Ns] + [(N_fixed, M, 'M') for M in Ms]
+    for N, M, swept in configs:
+        scene = SyntheticDLOScene(num_nodes=M, num_pts=N, motion=0.05, seed=seed)
+        X_0 = scene.frame(0)['points']
+        X_1 = scene.frame(1)['points']
+
+        register_ms, (Y, sigma2) = time_call(lambda: register(X_0, M, 0.05, max_iter=100), repeats)
+        sort_ms, Y = time_call(lambda: sort_pts(Y), repeats)
+        cpd_ms, (_, _, info) = time_call(lambda: track_step(X_1, Y, sigma2), repeats)
+
+        rows.append({'swept': swept, 'N': len(X_0), 'M': M,
+                     'register_ms': register_ms, 'sort_pts_ms': sort_ms,
+                     'cpd_lle_ms': cpd_ms, 'cpd_lle_iterations': info['iterations'],
+                     'cpd_lle_ms_per_iteration': cpd_ms / max(info['iterations'], 1)})
+        print(rows[-1])
+    return rows
+
+def sweep_skeleton (trackdlo_utils, lengths, repeats=3, seed=0):
+    import cv2
+    from tracking_core import color_thresholding
+    rows = []
+    for length in lengths:
+        scene = SyntheticDLOScene(length=length, seed=seed)
+        rgb, _ = scene.render(0)
+        mask = color_thresholding(rgb, np.full(rgb.shape[0:2], 255, dtype=np.uint8))
+        mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+        skeleton_ms, _ = time_call(lambda: trackdlo_utils.extract_connected_skeleton(False, mask, img_scale=1, seg_length=8, max_curvature=25), repeats)
+        rows.append({'length': length, 'mask_pixels': int(np.count_nonzero(mask[:, :, 0])), 'extract_connected_skeleton_ms': skeleton_ms})
+        print(rows[-1])
+    return rows
+
+# runs one sweep into results[name]. a failing sweep (e.g. an incompatible version of an optional dependency)
+# is recorded as skipped, like in benchmarks.py, and the results so far are written after every sweep
+def run_sweep (results, name, fn, output):
+    try:
+        results[name] = fn()
+    except Exception as e:
+        print(name + ' sweep skipped: ' + repr(e))
+        results[name] = []
+        results['skipped'][name] = 'failed: ' + repr(e)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def plot (results, path):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib not available, no chart written')
+        return
+    if len(results['registration']) == 0:
+        print('no registration results, no chart written')
+        return
+
+    num_plots = 3 if len(results['skeleton']) != 0 else 2
+    fig, axes = plt.subplots(1, num_plots, figsize=(5*num_plots, 4))
+    for ax, swept, fixed in zip(axes, ['N', 'M'], ['M', 'N']):
+        rows = [r for r in results['registration'] if r['swept'] == swept]
+        x = [r[swept] for r in rows]
+        for key in ['register_ms', 'sort_pts_ms', 'cpd_lle_ms', 'cpd_lle_ms_per_iteration']:
+            ax.loglog(x, [r[key] for r in rows], 'o-', label=key)
+        ax.set_xlabel(swept + ' (' + fixed + ' = ' + str(rows[0][fixed]) + ')')
+        ax.set_ylabel('ms')
+        ax.legend()
+    if num_plots == 3:
+        rows = results['skeleton']
+        axes[2].plot([r['mask_pixels'] for r in rows], [r['extract_connected_skeleton_ms'] for r in rows], 'o-')
+        axes[2].set_xlabel('mask pixels')
+        axes[2].set_ylabel('extract_connected_skeleton ms')
+    fig.tight_layout()
+    fig.savefig(path)
+    print('chart written to ' + path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scaling sweep of the registration code on synthetic DLO scenes.')
+    parser.add_argument('--output', default='sweep_scaling.json')
+    parser.add_argument('--chart', default='sweep_scaling.png')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--Ns', type=int, nargs='+', default=[250, 500, 1000, 2000, 4000])
+    parser.add_argument('--Ms', type=int, nargs='+', default=[20, 40, 80, 160])
+    parser.add_argument('--lengths', type=float, nargs='+', default=[0.25, 0.5, 0.75, 1.0])
+    args = parser.parse_args()
+
+    results = {'registration': [], 'skeleton': [], 'skipped': {}}
+    run_sweep(results, 'registration', lambda: sweep_registration(args.Ns, args.Ms, repeats=args.repeats), args.output)
+    trackdlo_utils = load_trackdlo_utils()
+    if trackdlo_utils is None:
+        results['skipped']['skeleton'] = 'module not available'
+    else:
+        run_sweep(results, 'skeleton', lambda: sweep_skeleton(trackdlo_utils, args.lengths), args.output)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to ' + args.output)
+    plot(results, args.chart)
@@ -0,0 +1,182 @@
+import numpy as np
+import cv2
+
+# synthetic deformable linear object scenes for benchmarks and tests without a camera.
+# the DLO is a tube around a parametric 3D curve in the camera frame (z forward, about 0.7 m from the camera).
+# a scene gives, for every frame, the observed point cloud (visible surface points plus noise and outliers),
+# the ground truth nodes and their visibility, and can render rgb and depth images
+
+proj_matrix = np.array([[918.359130859375,              0.0, 645.8908081054688, 0.0], \
+                        [             0.0, 916.265869140625,   354.02392578125, 0.0], \
+                        [             0.0,              0.0,               1.0, 0.0]])
+
+# RGB colors used by render. the rope color passes the blue range of color_thresholding
+rope_color = (0, 60, 200)
+occluder_color = (200, 200, 200)
+background_color = (40, 40, 40)
+
+# arc length coordinate of each point of a polyline
+def arc_length (curve):
+    return np.concatenate(([0], np.cumsum(np.sqrt(np.sum(np.square(np.diff(curve, axis=0)), axis=1)))))
+
+# num_samples points at equal arc length along a polyline
+def resample_curve (curve, num_samples):
+    s = arc_length(curve)
+    s_new = np.linspace(0, s[-1], num_samples)
+    return np.vstack([np.interp(s_new, s, curve[:, d]) for d in range (0, 3)]).T
+
+# parametric centerline at time t (s): a planar wave with an out of plane bend, resampled to length (m).
+# motion (m/s) moves the wave along the curve and the whole curve sideways
+def dlo_curve (length, t=0.0, motion=0.0, center=(0.0, 0.0, 0.7), num_samples=2000):
+    u = np.linspace(-0.5, 0.5, 4*num_samples)
+    phase = 20 * motion * t
+    curve = np.vstack((u * length,
+                       0.15 * length * np.sin(2*np.pi*u + phase),
+                       0.1 * length * np.cos(np.pi*u + 0.5*phase))).T
+    curve = resample_curve(curve, 2*num_samples)
+    curve = resample_curve(curve * length / arc_length(curve)[-1], num_samples)
+    return curve + np.array(center) + np.array([motion * t, 0, 0])
+
+# whether the segments from the camera origin to the points (N*3) hit a sphere (vectorized line_sphere_intersection)
+def sphere_occludes (points, sphere_center, radius):
+    sphere_center = np.asarray(sphere_center, dtype=float)
+    # segment A + d*(B - A) with A = 0, B = points, d in [0, 1]
+    a = np.sum(np.square(points), axis=1)
+    b = -2 * np.matmul(points, sphere_center)
+    c = np.sum(np.square(sphere_center)) - radius**2
+    delta = b**2 - 4*a*c
+    hit = delta >= 0
+    sqrt_delta = np.sqrt(np.maximum(delta, 0))
+    d1 = (-b - sqrt_delta) / (2*a)
+    d2 = (-b + sqrt_delta) / (2*a)
+    return hit & (d2 >= 0) & (d1 <= 1)
+
+# whether the segments from the camera origin to the points (N*3) hit an axis aligned box (slab test)
+def box_occludes (points, box_min, box_max):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = np.asarray(box_min)[None, :] / points
+        t2 = np.asarray(box_max)[None, :] / points
+    t_near = np.nanmax(np.minimum(t1, t2), axis=1)
+    t_far = np.nanmin(np.maximum(t1, t2), axis=1)
+    return (t_near <= t_far) & (t_far >= 0) & (t_near <= 1)
+
+class SyntheticDLOScene:
+    # length: DLO length (m). num_nodes: ground truth nodes. num_pts: visible points per frame before occlusion.
+    # noise: gaussian noise (m). outlier_ratio: uniform outliers in the DLO bounding box, relative to num_pts.
+    # motion: speed (m/s). spheres: [(center, radius)]. boxes: [(box_min, box_max)]. radius: tube radius (m)
+    def __init__(self, length=0.5, num_nodes=40, num_pts=1000, noise=0.001, outlier_ratio=0.0, motion=0.0,
+                 spheres=[], boxes=[], radius=0.01, frame_rate=30.0, seed=0):
+        self.length = length
+        self.num_nodes = num_nodes
+        self.num_pts = num_pts
+        self.noise = noise
+        self.outlier_ratio = outlier_ratio
+        self.motion = motion
+        self.spheres = spheres
+        self.boxes = boxes
+        self.radius = radius
+        self.frame_rate = frame_rate
+        self.seed = seed
+
+    def occluded (self, points):
+        occluded = np.zeros(len(points), dtype=bool)
+        for center, r in self.spheres:
+            occluded |= sphere_occludes(points, center, r)
+        for box_min, box_max in self.boxes:
+            occluded |= box_occludes(points, box_min, box_max)
+        return occluded
+
+    # points on the camera facing half of the tube around the curve
+    def surface_points (self, curve, num_pts, rng):
+        idx = rng.integers(0, len(curve), num_pts)
+        tangents = np.gradient(curve, axis=0)[idx]
+        tangents /= np.linalg.norm(tangents, axis=1)[:, None]
+        to_camera = -curve[idx] / np.linalg.norm(curve[idx], axis=1)[:, None]
+        normal_1 = np.cross(tangents, to_camera)
+        normal_1 /= np.linalg.norm(normal_1, axis=1)[:, None]
+        normal_2 = np.cross(normal_1, tangents)
+        angle = rng.uniform(-np.pi/2, np.pi/2, num_pts)
+        return curve[idx] + self.radius * (np.cos(angle)[:, None] * normal_2 + np.sin(angle)[:, None] * normal_1)
+
+    # frame i: {'stamp', 'points' (N*3 float32), 'nodes' (M*3), 'node_visible' (M booleans)}.
+    # the same i always gives the same frame
+    def frame (self, i):
+        rng = np.random.default_rng([self.seed, i])
+        t = i / self.frame_rate
+        curve = dlo_curve(self.length, t, self.motion)
+        nodes = resample_curve(curve, self.num_nodes)
+
+        points = self.surface_points(curve, self.num_pts, rng)
+        points = points[~self.occluded(points)]
+        points = points + rng.normal(0, self.noise, points.shape)
+
+        num_outliers = int(self.outlier_ratio * self.num_pts)
+        if num_outliers > 0:
+            lower = np.min(curve, axis=0) - 0.05
+            upper = np.max(curve, axis=0) + 0.05
+            points = np.vstack((points, rng.uniform(lower, upper, (num_outliers, 3))))
+            points = points[rng.permutation(len(points))]
+
+        return {'stamp': t,
+                'points': points.astype(np.float32),
+                'nodes': nodes,
+                'node_visible': ~self.occluded(nodes)}
+
+    # rgb (RGB order, uint8) and depth (uint16, mm) images of frame i, with the occluders in front of the DLO
+    def render (self, i, proj_matrix=proj_matrix, image_shape=(720, 1280), num_render_pts=50000):
+        h, w = image_shape
+        fx, fy = proj_matrix[0, 0], proj_matrix[1, 1]
+        cx, cy = proj_matrix[0, 2], proj_matrix[1, 2]
+
+        # unit depth rays of all pixels
+        vs, us = np.mgrid[0:h, 0:w]
+        rays = np.dstack(((us - cx) / fx, (vs - cy) / fy, np.ones((h, w)))).reshape(-1, 3)
+        depth = np.full(h*w, np.inf)
+        rgb = np.empty((h*w, 3), dtype=np.uint8)
+        rgb[:] = background_color
+
+        # occluders: per pixel ray intersection
+        for center, r in self.spheres:
+            center = np.asarray(center, dtype=float)
+            a = np.sum(np.square(rays), axis=1)
+            b = -2 * np.matmul(rays, center)
+            c = np.sum(np.square(center)) - r**2
+            delta = b**2 - 4*a*c
+            z = (-b - np.sqrt(np.maximum(delta, 0))) / (2*a)
+            hit = (delta >= 0) & (z > 0) & (z < depth)
+            depth[hit] = z[hit]
+            rgb[hit] = occluder_color
+        for box_min, box_max in self.boxes:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t1 = np.asarray(box_min)[None, :] / rays
+                t2 = np.asarray(box_max)[None, :] / rays
+            t_near = np.nanmax(np.minimum(t1, t2), axis=1)
+            t_far = np.nanmin(np.maximum(t1, t2), axis=1)
+            hit = (t_near <= t_far) & (t_near > 0) & (t_near < depth)
+            depth[hit] = t_near[hit]
+            rgb[hit] = occluder_color
+
+        # DLO: dense surface points splatted with a z-test, then closed to fill the gaps between points
+        rng = np.random.default_rng([self.seed, i, 1])
+        curve = dlo_curve(self.length, i / self.frame_rate, self.motion)
+        points = self.surface_points(curve, num_render_pts, rng)
+        pu = np.round(points[:, 0] / points[:, 2] * fx + cx).astype(int)
+        pv = np.round(points[:, 1] / points[:, 2] * fy + cy).astype(int)
+        inside = (pu >= 0) & (pu < w) & (pv >= 0) & (pv < h)
+        pixel = pv[inside] * w + pu[inside]
+        z = points[inside, 2]
+        dlo_depth = np.full(h*w, np.inf)
+        np.minimum.at(dlo_depth, pixel, z)
+        dlo_depth = dlo_depth.reshape(h, w)
+        dlo_mask = np.isfinite(dlo_depth).astype(np.uint8)
+        closed_mask = cv2.morphologyEx(dlo_mask, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+        # fill the depth of the closed pixels from their neighbors
+        filled_depth = cv2.erode(np.where(np.isfinite(dlo_depth), dlo_depth, 1e6).astype(np.float32), np.ones((5, 5), np.uint8))
+        dlo_depth = np.where(closed_mask > 0, filled_depth, np.inf).reshape(-1)
+
+        front = dlo_depth < depth
+        depth[front] = dlo_depth[front]
+        rgb[front] = rope_color
+
+        depth_mm = np.where(np.isfinite(depth), np.round(depth * 1000), 0).astype(np.uint16)
+        return rgb.reshape(h, w, 3), depth_mm.reshape(h, w)
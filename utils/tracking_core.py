@@ -0,0 +1,890 @@
+import numpy as np
+import scipy.linalg
+import cv2
+import time
+import sys
+from collections import deque
+from os.path import dirname, abspath, join
+from scipy.sparse.csgraph import minimum_spanning_tree, dijkstra
+
+# shared with the package's python nodes
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'trackdlo/src'))
+from stage_metrics import metrics
+
+# ROS independent part of tracking_test.py: point extraction, downsampling, registration and cpd_lle.
+# used by the tracking node and by the offline tools, which run without a ROS master
+
+def pt2pt_dis_sq(pt1, pt2):
+    return np.sum(np.square(pt1 - pt2))
+
+def pt2pt_dis(pt1, pt2):
+    return np.sqrt(np.sum(np.square(pt1 - pt2)))
+
+# memory layout of the x, y, z fields of an organized PointCloud2
+def pointcloud2_layout (pc):
+    offsets = {}
+    for field in pc.fields:
+        if field.name in ('x', 'y', 'z'):
+            offsets[field.name] = field.offset
+    return {'height': pc.height, 'width': pc.width, 'point_step': pc.point_step, 'row_step': pc.row_step,
+            'offsets': [offsets['x'], offsets['y'], offsets['z']], 'is_bigendian': pc.is_bigendian}
+
+# view a PointCloud2 data buffer with the given layout as a (height, width) structured array with x, y, z fields
+def xyz_view_from_buffer (buffer, layout):
+    byte_order = '>' if layout['is_bigendian'] else '<'
+    xyz_dtype = np.dtype({'names': ['x', 'y', 'z'],
+                          'formats': [byte_order + 'f4'] * 3,
+                          'offsets': layout['offsets'],
+                          'itemsize': layout['point_step']})
+    return np.ndarray(shape=(layout['height'], layout['width']), dtype=xyz_dtype, buffer=buffer, strides=(layout['row_step'], layout['point_step']))
+
+# view the x, y, z fields of an organized PointCloud2 as a (height, width) structured array
+# the view shares memory with pc.data, nothing is copied
+def pointcloud2_xyz_view (pc):
+    return xyz_view_from_buffer(pc.data, pointcloud2_layout(pc))
+
+# gather the xyz coordinates of the points where mask (height * width, single channel) is nonzero
+# returns an N*3 float32 array. only the selected points are copied
+def extract_masked_xyz (pc, mask):
+    return gather_masked_xyz(pointcloud2_xyz_view(pc), mask)
+
+# same as extract_masked_xyz, for a structured view from xyz_view_from_buffer
+def gather_masked_xyz (xyz_view, mask):
+    selected = xyz_view.reshape(-1)[np.flatnonzero(mask)]
+
+    pts = np.empty((len(selected), 3), dtype=np.float32)
+    pts[:, 0] = selected['x']
+    pts[:, 1] = selected['y']
+    pts[:, 2] = selected['z']
+    return pts
+
+# back-project the pixels where mask is nonzero using the depth image aligned to the rgb image
+# depth is either uint16 (mm) or float (m). returns an N*3 float32 array
+def extract_masked_xyz_from_depth (depth, mask, proj_matrix):
+    vs, us = np.nonzero(mask)
+    if depth.dtype == np.uint16:
+        pc_z = depth[vs, us].astype(np.float32) / 1000.0
+    else:
+        pc_z = depth[vs, us].astype(np.float32)
+
+    fx = proj_matrix[0, 0]
+    fy = proj_matrix[1, 1]
+    cx = proj_matrix[0, 2]
+    cy = proj_matrix[1, 2]
+
+    pts = np.empty((len(pc_z), 3), dtype=np.float32)
+    pts[:, 0] = (us - cx) * pc_z / fx
+    pts[:, 1] = (vs - cy) * pc_z / fy
+    pts[:, 2] = pc_z
+    return pts
+
+# voxel grid filter. points are binned into leaf_size cubes and each occupied voxel is replaced by the centroid of its points (mode='centroid')
+# or by its first point in input order (mode='first'). the output keeps the input dtype
+def voxel_downsample (pts, leaf_size, mode='centroid'):
+    if len(pts) == 0:
+        return pts
+
+    # the grid starts half a voxel below the minimum bound, like open3d's voxel_down_sample, so the same points
+    # share a voxel as with the open3d filter this replaces
+    min_bound = np.amin(pts, axis=0) - leaf_size / 2
+
+    # pack the integer voxel coordinates into one key per point
+    voxel_coords = np.floor((pts - min_bound) / leaf_size).astype(np.int64)
+    dims = np.amax(voxel_coords, axis=0) + 1
+    keys = (voxel_coords[:, 0] * dims[1] + voxel_coords[:, 1]) * dims[2] + voxel_coords[:, 2]
+
+    # a stable sort keeps the input order within each voxel
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = np.append(0, np.flatnonzero(np.diff(sorted_keys)) + 1)
+
+    if mode == 'first':
+        return pts[order[starts]]
+
+    sums = np.add.reduceat(pts[order], starts, axis=0, dtype=np.float64)
+    counts = np.diff(np.append(starts, len(pts)))
+    return (sums / counts[:, None]).astype(pts.dtype)
+
+# color thresholding of an rgb image. pixels where occlusion_mask (single channel) is zero are removed
+def color_thresholding (cur_image, occlusion_mask, use_eval_rope=True):
+    hsv_image = cv2.cvtColor(cur_image, cv2.COLOR_RGB2HSV)
+
+    if not use_eval_rope:
+        # color thresholding
+        lower = (90, 90, 90)
+        upper = (120, 255, 255)
+        mask = cv2.inRange(hsv_image, lower, upper)
+    else:
+        # color thresholding
+        # --- rope blue ---
+        lower = (90, 60, 40)
+        upper = (130, 255, 255)
+        mask_dlo = cv2.inRange(hsv_image, lower, upper).astype('uint8')
+
+        # --- tape red ---
+        lower = (130, 60, 40)
+        upper = (255, 255, 255)
+        mask_red_1 = cv2.inRange(hsv_image, lower, upper).astype('uint8')
+        lower = (0, 60, 40)
+        upper = (10, 255, 255)
+        mask_red_2 = cv2.inRange(hsv_image, lower, upper).astype('uint8')
+        mask_marker = cv2.bitwise_or(mask_red_1.copy(), mask_red_2.copy()).astype('uint8')
+
+        # combine masks
+        mask = cv2.bitwise_or(mask_marker.copy(), mask_dlo.copy())
+        mask = cv2.bitwise_and(mask.copy(), occlusion_mask.copy())
+
+    return mask
+
+# remove points without depth and downsample
+def filter_and_downsample (filtered_pc, leaf_size):
+    # also removes points without depth (zero or nan)
+    # filtered_pc = filtered_pc[filtered_pc[:, 2] < 0.705]
+    filtered_pc = filtered_pc[filtered_pc[:, 2] > 0.58]
+    return voxel_downsample(filtered_pc, leaf_size)
+
+def register(pts, M, mu=0, max_iter=50):
+
+    # initial guess
+    X = pts.copy()
+    Y = np.vstack((np.arange(0, 0.1, (0.1/M)), np.zeros(M), np.zeros(M))).T
+    if len(pts[0]) == 2:
+        Y = np.vstack((np.arange(0, 0.1, (0.1/M)), np.zeros(M))).T
+    s = 1
+    N = len(pts)
+    D = len(pts[0])
+
+    def get_estimates (Y, s):
+
+        # construct the P matrix
+        P = np.sum((X[None, :, :] - Y[:, None, :]) ** 2, axis=2)
+
+        c = (2 * np.pi * s) ** (D / 2)
+        c = c * mu / (1 - mu)
+        c = c * M / N
+
+        P = np.exp(-P / (2 * s))
+        den = np.sum(P, axis=0)
+        den = np.tile(den, (M, 1))
+        den[den == 0] = np.finfo(float).eps
+        den += c
+
+        P = np.divide(P, den)  # P is M*N
+        Pt1 = np.sum(P, axis=0)  # equivalent to summing from 0 to M (results in N terms)
+        P1 = np.sum(P, axis=1)  # equivalent to summing from 0 to N (results in M terms)
+        Np = np.sum(P1)
+        PX = np.matmul(P, X)
+
+        # get new Y
+        P1_expanded = np.full((D, M), P1).T
+        new_Y = PX / P1_expanded
+
+        # get new sigma2
+        Y_N_arr = np.full((N, M, 3), Y)
+        Y_N_arr = np.swapaxes(Y_N_arr, 0, 1)
+        X_M_arr = np.full((M, N, 3), X)
+        diff = Y_N_arr - X_M_arr
+        diff = np.square(diff)
+        diff = np.sum(diff, 2)
+        new_s = np.sum(np.sum(P*diff, axis=1), axis=0) / (Np*D)
+
+        return new_Y, new_s
+
+    prev_Y, prev_s = Y, s
+    new_Y, new_s = get_estimates(prev_Y, prev_s)
+    
+    for it in range (max_iter):
+        prev_Y, prev_s = new_Y, new_s
+        new_Y, new_s = get_estimates(prev_Y, prev_s)
+
+    return new_Y, new_s
+
+# order the nodes along the dlo using the minimum spanning tree of the node set
+# returns an index permutation: Y_0[sort_pts_idx(Y_0)] is the sorted node set
+# head (optional) -- if provided, the order is reversed when the first node is more than 8 cm away from head (same as evaluator::sort_pts)
+def sort_pts_idx (Y_0, head=None):
+    N = len(Y_0)
+    if N < 3:
+        return np.arange(N)
+
+    dis = np.sqrt(np.sum(np.square(Y_0[:, None, :] - Y_0[None, :, :]), axis=2))
+    # csgraph treats zero (and eps sized) entries as missing edges. a constant offset on every edge keeps coincident
+    # nodes connected and does not change which spanning tree is minimal
+    dis = dis + 1e-9
+    np.fill_diagonal(dis, 0)
+
+    mst = minimum_spanning_tree(dis)
+    mst = (mst + mst.T).tocsr()
+
+    # the diameter path of the tree runs between the two dlo tips
+    dis_from_0 = dijkstra(mst, indices=0)
+    tip_1 = np.argmax(dis_from_0)
+    dis_from_tip_1, predecessors = dijkstra(mst, indices=tip_1, return_predecessors=True)
+    tip_2 = np.argmax(dis_from_tip_1)
+
+    on_path = np.zeros(N, dtype=bool)
+    cur_node = tip_2
+    # a negative predecessor (-9999) means the tree is disconnected (e.g. nan nodes), the path ends there
+    while cur_node != tip_1 and cur_node >= 0:
+        on_path[cur_node] = True
+        cur_node = predecessors[cur_node]
+    on_path[tip_1] = True
+
+    # depth first traversal from tip_1. side branches are visited before the next node on the diameter path
+    order = []
+    visited = np.zeros(N, dtype=bool)
+    stack = [tip_1]
+    while len(stack) != 0:
+        cur_node = stack.pop()
+        if visited[cur_node]:
+            continue
+        visited[cur_node] = True
+        order.append(cur_node)
+
+        neighbors = mst.indices[mst.indptr[cur_node]:mst.indptr[cur_node+1]]
+        neighbors = neighbors[~visited[neighbors]]
+        stack += neighbors[on_path[neighbors]].tolist()
+        stack += neighbors[~on_path[neighbors]].tolist()
+    # nodes not connected to tip_1 keep their original order at the end
+    order = np.array(order + np.flatnonzero(~visited).tolist())
+
+    if head is None:
+        # same reversal semantics as growing the tree from node 0: 
+        # node 0 comes before the node it is closest to
+        nearest_to_0 = np.argmin(dis[0, 1:]) + 1
+        position = np.empty(N, dtype=int)
+        position[order] = np.arange(N)
+        if position[0] > position[nearest_to_0]:
+            order = order[::-1]
+    elif pt2pt_dis(Y_0[order[0]], head) > 0.08:
+        order = order[::-1]
+
+    return order
+
+def sort_pts (Y_0, head=None):
+    return Y_0[sort_pts_idx(Y_0, head)]
+
+# assuming Y is sorted
+# k -- going left for k indices, going right for k indices. a total of 2k neighbors.
+def get_nearest_indices (k, Y, idx):
+    if idx - k < 0:
+        # use more neighbors from the other side?
+        indices_arr = np.append(np.arange(0, idx, 1), np.arange(idx+1, idx+k+1+np.abs(idx-k)))
+        # indices_arr = np.append(np.arange(0, idx, 1), np.arange(idx+1, idx+k+1))
+        return indices_arr
+    elif idx + k >= len(Y):
+        last_index = len(Y) - 1
+        # use more neighbots from the other side?
+        indices_arr = np.append(np.arange(idx-k-(idx+k-last_index), idx, 1), np.arange(idx+1, last_index+1, 1))
+        # indices_arr = np.append(np.arange(idx-k, idx, 1), np.arange(idx+1, last_index+1, 1))
+        return indices_arr
+    else:
+        indices_arr = np.append(np.arange(idx-k, idx, 1), np.arange(idx+1, idx+k+1, 1))
+        return indices_arr
+
+def calc_LLE_weights (k, X):
+    W = np.zeros((len(X), len(X)))
+    for i in range (0, len(X)):
+        indices = get_nearest_indices(int(k/2), X, i)
+        xi, Xi = X[i], X[indices, :]
+        component = np.full((len(Xi), len(xi)), xi).T - Xi.T
+        Gi = np.matmul(component.T, component)
+        # Gi might be singular when k is large
+        try:
+            Gi_inv = np.linalg.inv(Gi)
+        except:
+            epsilon = 0.00001
+            Gi_inv = np.linalg.inv(Gi + epsilon*np.identity(len(Gi)))
+        wi = np.matmul(Gi_inv, np.ones((len(Xi), 1))) / np.matmul(np.matmul(np.ones(len(Xi),), Gi_inv), np.ones((len(Xi), 1)))
+        W[i, indices] = np.squeeze(wi.T)
+
+    return W
+
+def indices_array(n):
+    r = np.arange(n)
+    out = np.empty((n,n,2),dtype=int)
+    out[:,:,0] = r[:,None]
+    out[:,:,1] = r
+    return out
+
+# gaussian kernel G between the nodes, as used by cpd_lle: over the euclidean node distances, or over the
+# geodesic (arc length) node coordinates if use_geodesic
+def gaussian_kernel (Y, beta, use_geodesic=False):
+    if use_geodesic:
+        coord = geodesic_coordinates(Y)
+        node_dis_sq = np.square(coord[None, :] - coord[:, None])
+    else:
+        node_dis_sq = np.sum(np.square(Y[:, None, :] - Y[None, :, :]), 2)
+    return np.exp(-node_dis_sq / (2 * beta**2))
+
+# top-k eigenpairs of a kernel matrix G (e.g. from gaussian_kernel)
+# returns Q (M*k), lam (k) and the relative Frobenius norm error of the rank-k approximation
+def low_rank_kernel (G, rank):
+    M = len(G)
+    rank = min(rank, M)
+    # only the top-k eigenpairs are computed (in ascending order), not all M eigenvectors
+    lam, Q = scipy.linalg.eigh(G, subset_by_index=[M - rank, M - 1])
+    lam = lam[::-1]
+    Q = Q[:, ::-1]
+
+    # error of the approximation from its residual (O(M^2*k)), the remaining eigenvalues are not known
+    rel_err = np.linalg.norm(G - np.matmul(Q * lam, Q.T)) / np.linalg.norm(G)
+    return Q.copy(), lam.copy(), rel_err
+
+# accuracy of the low rank approximation of a kernel matrix G for a list of ranks, as a list of (rank, relative error) pairs
+def kernel_rank_report (G, ranks):
+    lam = np.linalg.eigvalsh(G)[::-1]
+    total = np.sum(np.square(lam))
+
+    report = []
+    for rank in ranks:
+        report.append((rank, np.sqrt(np.sum(np.square(lam[rank:])) / total)))
+    return report
+
+# deadline -- (optional) time.time() value by which the EM loop should stop; the latest estimate is returned
+# kernel_rank -- (optional) replaces G by its top-k eigenpairs (the same euclidean or geodesic kernel, from the nodes of
+#                this call) and solves the M step in O(M^2*k) per iteration. info['kernel_rel_err'] is the approximation error
+# node_weights, pt_weights -- (optional) visibility weights (M and N) from visibility_weights, multiplied into P
+# return_info -- if True, also return a dict with 'converged', 'iterations', 'error' (last squared node displacement) and 'timed_out'
+def cpd_lle (X, Y_0, beta, alpha, gamma, mu, max_iter=50, tol=0.00001, include_lle=True, use_geodesic=False, use_prev_sigma2=False, sigma2_0=None, use_squarem=False, deadline=None, return_info=False, kernel_rank=None, node_weights=None, pt_weights=None):
+
+    # define params
+    M = len(Y_0)
+    N = len(X)
+    D = len(X[0])
+
+    # initialization
+    # faster G calculation
+    diff = Y_0[:, None, :] - Y_0[None, :,  :]
+    diff = np.square(diff)
+    diff = np.sum(diff, 2)
+
+    converted_node_dis = []
+    if not use_geodesic:
+        # Gaussian Kernel
+        G = np.exp(-diff / (2 * beta**2))
+    else:
+        # compute the geodesic distances between nodes
+        seg_dis = np.sqrt(np.sum(np.square(np.diff(Y_0, axis=0)), axis=1))
+        converted_node_coord = []
+        last_pt = 0
+        converted_node_coord.append(last_pt)
+        for i in range (1, M):
+            last_pt += seg_dis[i-1]
+            converted_node_coord.append(last_pt)
+        converted_node_coord = np.array(converted_node_coord)
+        converted_node_dis = np.abs(converted_node_coord[None, :] - converted_node_coord[:, None])
+        converted_node_dis_sq = np.square(converted_node_dis)
+
+        # Gaussian Kernel
+        G = np.exp(-converted_node_dis_sq / (2 * beta**2))
+
+        # temp
+        # G[converted_node_dis > 0.07] = 0
+    
+    Y = Y_0.copy()
+
+    # initialize sigma2
+    if not use_prev_sigma2:
+        (N, D) = X.shape
+        (M, _) = Y.shape
+        diff = X[None, :, :] - Y[:, None, :]
+        err = diff ** 2
+        sigma2 = np.sum(err) / (D * M * N)
+    else:
+        sigma2 = sigma2_0
+
+    # get the LLE matrix. H = (I - L)^T (I - L) and H*G do not change between iterations
+    L = calc_LLE_weights(6, Y_0)
+    I_L = np.identity(M) - L
+    if kernel_rank is None:
+        H = np.matmul(I_L.T, I_L)
+        HG = np.matmul(H, G)
+
+    P_vis = None
+    if node_weights is not None or pt_weights is not None:
+        P_vis = np.ones((M, N))
+        if node_weights is not None:
+            P_vis *= node_weights[:, None]
+        if pt_weights is not None:
+            P_vis *= pt_weights[None, :]
+
+    kernel_rel_err = 0.0
+    if kernel_rank is not None:
+        Q_G, lam_G, kernel_rel_err = low_rank_kernel(G, kernel_rank)
+        V_G = lam_G[:, None] * Q_G.T
+        # H is never formed, H*Q and H*Y_0 are two thin products each
+        HQ_G = np.matmul(I_L.T, np.matmul(I_L, Q_G))
+        HY_0 = np.matmul(I_L.T, np.matmul(I_L, Y_0))
+    
+    # E and M step time summed over the EM iterations of this call, recorded as one sample per call
+    em_step_time = {'e_step': 0.0, 'm_step': 0.0}
+
+    # one EM iteration starting from (Y, sigma2), with Y = Y_0 + G*W
+    # returns the updated node positions, their W, the updated sigma2 and the objective at (Y, W, sigma2):
+    # the negative log-likelihood plus the coherence (alpha) and LLE (gamma) penalties that the M step minimizes
+    def em_step (Y, W_Y, sigma2):
+        e_step_start = time.time()
+
+        # ----- E step: compute posteriori probability matrix P -----
+        # faster P computation
+        pts_dis_sq = np.sum((X[None, :, :] - Y[:, None, :]) ** 2, axis=2)
+        c = (2 * np.pi * sigma2) ** (D / 2)
+        c = c * mu / (1 - mu)
+        c = c * M / N
+        P = np.exp(-pts_dis_sq / (2 * sigma2))
+        if P_vis is not None:
+            P = P * P_vis
+        den = np.sum(P, axis=0)
+        den = np.tile(den, (M, 1))
+        den[den == 0] = np.finfo(float).eps
+        den += c
+        P = np.divide(P, den)
+
+        max_p_nodes = np.argmax(P, axis=0)
+
+        # if use geodesic, overwrite P
+        # this section looks long, but it is simply replacing the Euclidean distances in P with geodesic distances
+        if use_geodesic:
+            potential_2nd_max_p_nodes_1 = max_p_nodes - 1
+            potential_2nd_max_p_nodes_2 = max_p_nodes + 1
+            potential_2nd_max_p_nodes_1 = np.where(potential_2nd_max_p_nodes_1 < 0, 1, potential_2nd_max_p_nodes_1)
+            potential_2nd_max_p_nodes_2 = np.where(potential_2nd_max_p_nodes_2 > M-1, M-2, potential_2nd_max_p_nodes_2)
+            potential_2nd_max_p_nodes_1_select = np.vstack((np.arange(0, N), potential_2nd_max_p_nodes_1)).T
+            potential_2nd_max_p_nodes_2_select = np.vstack((np.arange(0, N), potential_2nd_max_p_nodes_2)).T
+            potential_2nd_max_p_1 = P.T[tuple(map(tuple, potential_2nd_max_p_nodes_1_select.T))]
+            potential_2nd_max_p_2 = P.T[tuple(map(tuple, potential_2nd_max_p_nodes_2_select.T))]
+            next_max_p_nodes = np.where(potential_2nd_max_p_1 > potential_2nd_max_p_2, potential_2nd_max_p_nodes_1, potential_2nd_max_p_nodes_2)
+            node_indices_diff = max_p_nodes - next_max_p_nodes
+            max_node_smaller_index = np.arange(0, N)[node_indices_diff < 0]
+            max_node_larger_index = np.arange(0, N)[node_indices_diff > 0]
+            dis_to_max_p_nodes = np.sqrt(np.sum(np.square(Y[max_p_nodes]-X), axis=1))
+            dis_to_2nd_largest_p_nodes = np.sqrt(np.sum(np.square(Y[next_max_p_nodes]-X), axis=1))
+            converted_P = np.zeros((M, N)).T
+
+            for idx in max_node_smaller_index:
+                converted_P[idx, 0:max_p_nodes[idx]+1] = converted_node_dis[max_p_nodes[idx], 0:max_p_nodes[idx]+1] + dis_to_max_p_nodes[idx]
+                converted_P[idx, next_max_p_nodes[idx]:M] = converted_node_dis[next_max_p_nodes[idx], next_max_p_nodes[idx]:M] + dis_to_2nd_largest_p_nodes[idx]
+
+            for idx in max_node_larger_index:
+                converted_P[idx, 0:next_max_p_nodes[idx]+1] = converted_node_dis[next_max_p_nodes[idx], 0:next_max_p_nodes[idx]+1] + dis_to_2nd_largest_p_nodes[idx]
+                converted_P[idx, max_p_nodes[idx]:M] = converted_node_dis[max_p_nodes[idx], max_p_nodes[idx]:M] + dis_to_max_p_nodes[idx]
+
+            converted_P = converted_P.T
+
+            P = np.exp(-np.square(converted_P) / (2 * sigma2))
+            if P_vis is not None:
+                P = P * P_vis
+            den = np.sum(P, axis=0)
+            den = np.tile(den, (M, 1))
+            den[den == 0] = np.finfo(float).eps
+            c = (2 * np.pi * sigma2) ** (D / 2)
+            c = c * mu / (1 - mu)
+            c = c * M / N
+            den += c
+
+            P = np.divide(P, den)
+
+        Pt1 = np.sum(P, axis=0)
+        P1 = np.sum(P, axis=1)
+        Np = np.sum(P1)
+        PX = np.matmul(P, X)
+
+        # print(Pt1)
+        m_step_start = time.time()
+        em_step_time['e_step'] += m_step_start - e_step_start
+    
+        # ----- M step: solve for new weights and variance -----
+        if kernel_rank is not None:
+            # low rank kernel G ~= Q diag(lam) Q^T. A = c*I + U*V with U (M*k) and V (k*M),
+            # so A^-1 follows from the woodbury identity with a k*k solve
+            c_reg = alpha * sigma2
+            if include_lle:
+                U = P1[:, None] * Q_G + sigma2 * gamma * HQ_G
+                B_matrix = PX - P1[:, None] * Y_0 - sigma2 * gamma * HY_0
+            else:
+                U = P1[:, None] * Q_G
+                B_matrix = PX - P1[:, None] * Y_0
+
+            # solve for W
+            small_system = c_reg * np.identity(len(lam_G)) + np.matmul(V_G, U)
+            W = (B_matrix - np.matmul(U, np.linalg.solve(small_system, np.matmul(V_G, B_matrix)))) / c_reg
+
+            T = Y_0 + np.matmul(Q_G, np.matmul(V_G, W))
+            trXtdPt1X = np.sum(Pt1 * np.sum(np.square(X), axis=1))
+            trPXtT = np.sum(PX * T)
+            trTtdP1T = np.sum(P1[:, None] * np.square(T))
+        else:
+            if include_lle:
+                A_matrix = np.matmul(np.diag(P1), G) + alpha * sigma2 * np.identity(M) + sigma2 * gamma * HG
+                B_matrix = PX - np.matmul(np.diag(P1) + sigma2*gamma*H, Y_0)
+            else:
+                A_matrix = np.matmul(np.diag(P1), G) + alpha * sigma2 * np.identity(M)
+                B_matrix = PX - np.matmul(np.diag(P1), Y_0)
+
+            # solve for W
+            W = np.linalg.solve(A_matrix, B_matrix)
+
+            T = Y_0 + np.matmul(G, W)
+            trXtdPt1X = np.trace(np.matmul(np.matmul(X.T, np.diag(Pt1)), X))
+            trPXtT = np.trace(np.matmul(PX.T, T))
+            trTtdP1T = np.trace(np.matmul(np.matmul(T.T, np.diag(P1)), T))
+
+        # solve for sigma^2
+        new_sigma2 = (trXtdPt1X - 2*trPXtT + trTtdP1T) / (Np * D)
+
+        # objective of the current estimate (up to a constant), used by the squarem safeguard
+        nll = -np.sum(np.log(den[0])) + N * D / 2 * np.log(sigma2)
+        if kernel_rank is not None:
+            coherence = np.sum(lam_G[:, None] * np.square(np.matmul(Q_G.T, W_Y)))
+        else:
+            coherence = np.sum(W_Y * np.matmul(G, W_Y))
+        objective = nll + alpha / 2 * coherence
+        if include_lle:
+            objective += gamma / 2 * np.sum(np.square(np.matmul(I_L, Y)))
+
+        em_step_time['m_step'] += time.time() - m_step_start
+        return T, W, new_sigma2, objective
+
+    # deadline mode: stop before starting an EM step that is expected to end after the deadline (a time.time() value).
+    # at least one EM step is always taken
+    start_time = time.time()
+    def out_of_time (num_steps):
+        if deadline is None or num_steps == 0:
+            return False
+        step_time = (time.time() - start_time) / num_steps
+        return time.time() + step_time > deadline
+
+    converged = False
+    error = np.inf
+    num_steps = 0
+    # Y = Y_0 + G*W, the EM loop starts at Y_0
+    W = np.zeros(Y.shape)
+    if not use_squarem:
+        # loop until convergence or max_iter reached
+        for it in range (0, max_iter):
+            T, W, sigma2, _ = em_step(Y, W, sigma2)
+            error = pt2pt_dis_sq(Y, T)
+            num_steps = it + 1
+
+            # update Y
+            if error < tol:
+                # if converged, break loop
+                Y = T
+                converged = True
+                break
+            else:
+                # keep going until max iteration is reached
+                Y = T
+
+                if it < max_iter - 1 and out_of_time(num_steps):
+                    break
+    else:
+        # squarem (Varadhan and Roland 2008, scheme S3) on the (Y, sigma2) iterates
+        # each cycle takes two EM steps, extrapolates along them and stabilizes with a third EM step.
+        # the extrapolated point is only accepted if it does not increase the objective (negative log-likelihood plus
+        # the coherence and LLE penalties), otherwise the cycle falls back to the plain EM result.
+        # Y is affine in W, so W is extrapolated with the same coefficients as Y
+        num_steps = 0
+        while num_steps < max_iter and not converged and not out_of_time(num_steps):
+            Y_1, W_1, sigma2_1, _ = em_step(Y, W, sigma2)
+            num_steps += 1
+            error = pt2pt_dis_sq(Y, Y_1)
+            converged = error < tol
+            if converged or num_steps == max_iter or out_of_time(num_steps):
+                Y, W, sigma2 = Y_1, W_1, sigma2_1
+                break
+
+            Y_2, W_2, sigma2_2, objective_1 = em_step(Y_1, W_1, sigma2_1)
+            num_steps += 1
+            error = pt2pt_dis_sq(Y_1, Y_2)
+            converged = error < tol
+            if converged or num_steps == max_iter or out_of_time(num_steps):
+                Y, W, sigma2 = Y_2, W_2, sigma2_2
+                break
+
+            r = np.append((Y_1 - Y).flatten(), sigma2_1 - sigma2)
+            v = np.append((Y_2 - Y_1).flatten(), sigma2_2 - sigma2_1) - r
+            if np.linalg.norm(v) == 0:
+                Y, W, sigma2 = Y_2, W_2, sigma2_2
+                continue
+
+            # step length; -1 reproduces the plain EM result Y_2
+            step = min(-np.linalg.norm(r) / np.linalg.norm(v), -1)
+            Y_acc = Y - 2*step*(Y_1 - Y) + step**2 * (Y_2 - 2*Y_1 + Y)
+            W_acc = W - 2*step*(W_1 - W) + step**2 * (W_2 - 2*W_1 + W)
+            sigma2_acc = sigma2 - 2*step*(sigma2_1 - sigma2) + step**2 * (sigma2_2 - 2*sigma2_1 + sigma2)
+
+            if sigma2_acc > 0:
+                Y_3, W_3, sigma2_3, objective_acc = em_step(Y_acc, W_acc, sigma2_acc)
+                num_steps += 1
+                if np.isfinite(objective_acc) and objective_acc <= objective_1:
+                    error = pt2pt_dis_sq(Y_acc, Y_3)
+                    converged = error < tol
+                    Y, W, sigma2 = Y_3, W_3, sigma2_3
+                    continue
+
+            # fall back to the plain EM step
+            Y, W, sigma2 = Y_2, W_2, sigma2_2
+
+    # the outcome is counted here instead of being printed every frame. return_info gives it per call
+    timed_out = (not converged) and num_steps < max_iter
+    metrics.record('e_step', em_step_time['e_step'])
+    metrics.record('m_step', em_step_time['m_step'])
+    metrics.count('em_iterations', num_steps)
+    if timed_out:
+        metrics.count('em_timed_out')
+    elif not converged:
+        metrics.count('em_not_converged')
+
+    if return_info:
+        info = {'converged': bool(converged),
+                'iterations': num_steps,
+                'error': float(error),
+                'timed_out': timed_out}
+        if kernel_rank is not None:
+            info['kernel_rel_err'] = float(kernel_rel_err)
+        return Y, sigma2, info
+
+    return Y, sigma2
+
+# cpd_lle for K objects at once (e.g. several cables in the same scene)
+# X_list -- list of K point clouds (each N_k*D), the segmented points belonging to each object
+# Y_0_list -- list of K node sets (each M_k*D)
+# node sets and point clouds are zero padded to the largest M and N; padded entries are masked out of P, G and H
+# objects without points are left out of the batch: their nodes are returned unchanged, with sigma2_0 (or 0 if not given)
+# returns a list of K node sets and an array of K sigma2 values
+def cpd_lle_batch (X_list, Y_0_list, beta, alpha, gamma, mu, max_iter=50, tol=0.00001, include_lle=True, use_prev_sigma2=False, sigma2_0=None):
+
+    K = len(Y_0_list)
+    nonempty = [k for k in range (0, K) if len(X_list[k]) != 0]
+    if len(nonempty) != K:
+        if use_prev_sigma2:
+            sigma2_out = np.array(sigma2_0, dtype=float) * np.ones(K)
+        else:
+            sigma2_out = np.zeros(K)
+        Y_out = [np.array(Y_0_k, dtype=float) for Y_0_k in Y_0_list]
+        if len(nonempty) != 0:
+            Y_sub, sigma2_sub = cpd_lle_batch([X_list[k] for k in nonempty], [Y_0_list[k] for k in nonempty], beta, alpha, gamma, mu,
+                                              max_iter=max_iter, tol=tol, include_lle=include_lle,
+                                              use_prev_sigma2=use_prev_sigma2, sigma2_0=sigma2_out[nonempty])
+            for i, k in enumerate(nonempty):
+                Y_out[k] = Y_sub[i]
+            sigma2_out[nonempty] = sigma2_sub
+        return Y_out, sigma2_out
+
+    # define params
+    Ms = np.array([len(Y_0_k) for Y_0_k in Y_0_list])
+    Ns = np.array([len(X_k) for X_k in X_list])
+    M = np.amax(Ms)
+    N = np.amax(Ns)
+    D = len(X_list[0][0])
+
+    # pad inputs
+    X = np.zeros((K, N, D))
+    Y_0 = np.zeros((K, M, D))
+    x_mask = np.zeros((K, N))
+    y_mask = np.zeros((K, M))
+    for k in range (0, K):
+        X[k, 0:Ns[k]] = X_list[k]
+        Y_0[k, 0:Ms[k]] = Y_0_list[k]
+        x_mask[k, 0:Ns[k]] = 1
+        y_mask[k, 0:Ms[k]] = 1
+    node_pair_mask = y_mask[:, :, None] * y_mask[:, None, :]
+
+    # Gaussian kernel. padded nodes are disconnected from everything else
+    diff = Y_0[:, :, None, :] - Y_0[:, None, :, :]
+    diff = np.sum(np.square(diff), axis=3)
+    G = np.exp(-diff / (2 * beta**2)) * node_pair_mask
+
+    Y = Y_0.copy()
+    X_sq = np.einsum('knd,knd->kn', X, X)
+
+    def get_pts_dis_sq (Y):
+        Y_sq = np.einsum('kmd,kmd->km', Y, Y)
+        pts_dis_sq = Y_sq[:, :, None] + X_sq[:, None, :] - 2*np.einsum('kmd,knd->kmn', Y, X)
+        return np.maximum(pts_dis_sq, 0)
+
+    # initialize sigma2
+    if not use_prev_sigma2:
+        err = get_pts_dis_sq(Y) * y_mask[:, :, None] * x_mask[:, None, :]
+        sigma2 = np.sum(err, axis=(1, 2)) / (D * Ms * Ns)
+    else:
+        sigma2 = np.array(sigma2_0, dtype=float) * np.ones(K)
+
+    # get the LLE matrices. calc_LLE_weights takes k/2 neighbors on each side, so short objects use
+    # the largest even k below M_k; objects with fewer than 3 nodes have no LLE term
+    H = np.zeros((K, M, M))
+    for k in range (0, K):
+        lle_k = min(6, 2 * ((Ms[k] - 1) // 2))
+        if lle_k == 0:
+            continue
+        L = calc_LLE_weights(lle_k, Y_0_list[k])
+        H[k, 0:Ms[k], 0:Ms[k]] = np.matmul((np.identity(Ms[k]) - L).T, np.identity(Ms[k]) - L)
+    HG = np.matmul(H, G)
+    HY_0 = np.matmul(H, Y_0)
+    identity = np.identity(M)[None, :, :]
+
+    converged = np.zeros(K, dtype=bool)
+
+    # loop until all objects converged or max_iter reached
+    for it in range (0, max_iter):
+
+        # ----- E step: compute posteriori probability matrices P (K*M*N) -----
+        c = (2 * np.pi * sigma2) ** (D / 2)
+        c = c * mu / (1 - mu)
+        c = c * Ms / Ns
+        P = np.exp(-get_pts_dis_sq(Y) / (2 * sigma2[:, None, None]))
+        P *= y_mask[:, :, None] * x_mask[:, None, :]
+        den = np.sum(P, axis=1, keepdims=True)
+        den[den == 0] = np.finfo(float).eps
+        den += c[:, None, None]
+        P = P / den
+
+        Pt1 = np.sum(P, axis=1)
+        P1 = np.sum(P, axis=2)
+        Np = np.sum(P1, axis=1)
+        PX = np.matmul(P, X)
+
+        # ----- M step: solve for new weights and variances -----
+        s = sigma2[:, None, None]
+        if include_lle:
+            A_matrix = P1[:, :, None] * G + alpha * s * identity + s * gamma * HG
+            B_matrix = PX - P1[:, :, None] * Y_0 - s * gamma * HY_0
+        else:
+            A_matrix = P1[:, :, None] * G + alpha * s * identity
+            B_matrix = PX - P1[:, :, None] * Y_0
+
+        # solve for W
+        W = np.linalg.solve(A_matrix, B_matrix)
+
+        T = Y_0 + np.matmul(G, W)
+        trXtdPt1X = np.einsum('kn,knd,knd->k', Pt1, X, X)
+        trPXtT = np.einsum('kmd,kmd->k', PX, T)
+        trTtdP1T = np.einsum('km,kmd,kmd->k', P1, T, T)
+
+        # solve for sigma^2. objects that already converged keep their estimates
+        active = ~converged
+        sigma2 = np.where(active, (trXtdPt1X - 2*trPXtT + trTtdP1T) / (Np * D), sigma2)
+
+        # update Y
+        change = np.sum(np.square(Y - T), axis=(1, 2))
+        Y[active] = T[active]
+        converged |= change < tol
+
+        if np.all(converged):
+            break
+
+    metrics.count('batch_em_iterations', it + 1)
+    metrics.count('batch_em_not_converged', int(np.sum(~converged)))
+    return [Y[k, 0:Ms[k]] for k in range (0, K)], sigma2
+
+# adjusts the voxel size from frame to frame so that the downsampled point cloud size stays close to target_num_pts.
+# the leaf size is only changed when the point count leaves the band target_num_pts * (1 +- deadband),
+# and then it is scaled by (N / target)^gain, limited to max_step per frame and clamped to [min_leaf_size, max_leaf_size]
+class LeafSizeController:
+    def __init__(self, target_num_pts, leaf_size=0.005, min_leaf_size=0.002, max_leaf_size=0.02, deadband=0.2, gain=0.5, max_step=1.5):
+        self.target_num_pts = target_num_pts
+        self.leaf_size = leaf_size
+        self.min_leaf_size = min_leaf_size
+        self.max_leaf_size = max_leaf_size
+        self.deadband = deadband
+        self.gain = gain
+        self.max_step = max_step
+
+    def update(self, num_pts):
+        ratio = max(num_pts, 1) / self.target_num_pts
+        if 1 - self.deadband <= ratio <= 1 + self.deadband:
+            return self.leaf_size
+
+        scale = np.clip(ratio ** self.gain, 1 / self.max_step, self.max_step)
+        self.leaf_size = float(np.clip(self.leaf_size * scale, self.min_leaf_size, self.max_leaf_size))
+        return self.leaf_size
+
+# keeps the last few tracking results and extrapolates the node positions at a new timestamp
+# assuming constant velocity. the velocity of each node is the least squares slope over the history
+class NodePredictor:
+    def __init__(self, history_len=5, max_dt=0.5):
+        self.history = deque(maxlen=history_len)
+        # do not extrapolate across gaps longer than max_dt (seconds)
+        self.max_dt = max_dt
+
+    def reset(self):
+        self.history.clear()
+
+    def add(self, stamp, Y):
+        # a node set with a different number of nodes invalidates the history
+        if len(self.history) != 0 and self.history[-1][1].shape != Y.shape:
+            self.history.clear()
+        self.history.append((stamp, Y.copy()))
+
+    def predict(self, stamp):
+        last_stamp, last_Y = self.history[-1]
+        if len(self.history) < 2 or stamp - last_stamp > self.max_dt or stamp <= last_stamp:
+            return last_Y.copy()
+
+        stamps = np.array([h[0] for h in self.history])
+        Ys = np.array([h[1] for h in self.history])
+        dts = stamps - np.mean(stamps)
+        if np.sum(np.square(dts)) == 0:
+            return last_Y.copy()
+
+        # least squares velocity (M*D)
+        velocity = np.tensordot(dts, Ys - np.mean(Ys, axis=0), axes=(0, 0)) / np.sum(np.square(dts))
+        return last_Y + velocity * (stamp - last_stamp)
+
+# decides whether a frame is (almost) the same as the last registered frame, so that registration can be skipped.
+# a frame is static if the mask pixels that changed (XOR) are less than mask_threshold of the reference mask pixels,
+# and the centroid and the per-axis spread of the downsampled point cloud moved less than drift_threshold (m).
+# the reference is only replaced by set_reference (after a registration), so slow drift is not hidden, and at most
+# force_every-1 frames in a row are reported as static
+class StaticSceneDetector:
+    def __init__(self, mask_threshold=0.02, drift_threshold=0.003, force_every=30):
+        self.mask_threshold = mask_threshold
+        self.drift_threshold = drift_threshold
+        self.force_every = force_every
+        self.ref_mask = None
+        self.ref_count = 0
+        self.ref_centroid = None
+        self.ref_spread = None
+        self.num_static_in_row = 0
+        self.num_static = 0
+
+    def set_reference(self, mask, pts):
+        self.ref_mask = mask.copy()
+        self.ref_count = max(np.count_nonzero(mask), 1)
+        self.ref_centroid = np.mean(pts, axis=0)
+        self.ref_spread = np.std(pts, axis=0)
+        self.num_static_in_row = 0
+
+    def is_static(self, mask, pts):
+        if self.ref_mask is None or mask.shape != self.ref_mask.shape or len(pts) == 0:
+            return False
+        if self.num_static_in_row >= self.force_every - 1:
+            return False
+
+        changed = np.count_nonzero(cv2.bitwise_xor(mask, self.ref_mask))
+        if changed > self.mask_threshold * self.ref_count:
+            return False
+        if np.linalg.norm(np.mean(pts, axis=0) - self.ref_centroid) > self.drift_threshold:
+            return False
+        if np.max(np.abs(np.std(pts, axis=0) - self.ref_spread)) > self.drift_threshold:
+            return False
+
+        self.num_static_in_row += 1
+        self.num_static += 1
+        return True
+
+# arc length coordinate of each node along the node chain
+def geodesic_coordinates (Y):
+    seg_dis = np.sqrt(np.sum(np.square(np.diff(Y, axis=0)), axis=1))
+    return np.concatenate(([0], np.cumsum(seg_dis)))
+
+# initial node set: M nodes registered to the first point cloud, ordered along the DLO
+def initialize_nodes (filtered_pc, M=40, mu=0.05, max_iter=100):
+    init_nodes, sigma2 = register(filtered_pc, M, mu, max_iter=max_iter)
+    return sort_pts(init_nodes), sigma2
+
+# one tracking step with the cpd_lle parameters of the python tracker. returns (Y, sigma2, info)
+def track_step (filtered_pc, Y_0, sigma2, use_prev_sigma2=False, use_squarem=False, deadline=None, kernel_rank=None, node_weights=None, pt_weights=None):
+    return cpd_lle(filtered_pc, Y_0, 0.7, 5, 1, 0.05, 50, 0.00001, True, False, use_prev_sigma2, sigma2, use_squarem=use_squarem, deadline=deadline, return_info=True, kernel_rank=kernel_rank, node_weights=node_weights, pt_weights=pt_weights)
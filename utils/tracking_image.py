@@ -0,0 +1,76 @@
+import cv2
+import numpy as np
+
+# draws the tracking overlay (nodes and edges, colored by visibility) on a camera image.
+# the output buffer is reused between frames, so the result has to be published (or copied) before the next render.
+# all nodes and edges are drawn with four cv2.polylines calls in total, independent of the number of nodes
+class TrackingImageRenderer:
+    def __init__(self, half_resolution=False, node_radius=5, line_width=2,
+                 visible_node_color=(255, 150, 0), occluded_node_color=(255, 0, 0),
+                 visible_edge_color=(0, 255, 0), occluded_edge_color=(255, 0, 0)):
+        self.half_resolution = half_resolution
+        self.node_radius = node_radius
+        self.line_width = line_width
+        self.visible_node_color = visible_node_color
+        self.occluded_node_color = occluded_node_color
+        self.visible_edge_color = visible_edge_color
+        self.occluded_edge_color = occluded_edge_color
+        self.buffer = None
+        self.image_buffer = None
+        self.mask_buffer = None
+
+    def get_buffer(self, shape):
+        if self.buffer is None or self.buffer.shape != shape:
+            self.buffer = np.empty(shape, dtype=np.uint8)
+        return self.buffer
+
+    # image: h*w*3 uint8. us, vs: projected node pixels (in full resolution). visible: M booleans, edge i (node i to
+    # node i+1) takes the visibility of node i. if occlusion_mask_rgb is given, masked out pixels are darkened by half
+    def render(self, image, us, vs, visible, occlusion_mask_rgb=None):
+        us = np.asarray(us)
+        vs = np.asarray(vs)
+        visible = np.asarray(visible, dtype=bool)
+        scale = 1
+        if self.half_resolution:
+            scale = 0.5
+            h, w = image.shape[0] // 2, image.shape[1] // 2
+            if self.image_buffer is None or self.image_buffer.shape[0:2] != (h, w):
+                self.image_buffer = np.empty((h, w, 3), dtype=np.uint8)
+            image = cv2.resize(image, (w, h), dst=self.image_buffer, interpolation=cv2.INTER_AREA)
+            if occlusion_mask_rgb is not None:
+                if self.mask_buffer is None or self.mask_buffer.shape[0:2] != (h, w):
+                    self.mask_buffer = np.empty((h, w, 3), dtype=np.uint8)
+                occlusion_mask_rgb = cv2.resize(occlusion_mask_rgb, (w, h), dst=self.mask_buffer, interpolation=cv2.INTER_NEAREST)
+
+        tracking_img = self.get_buffer(image.shape)
+        if occlusion_mask_rgb is None:
+            np.copyto(tracking_img, image)
+        else:
+            # 0.5*image + 0.5*(image & mask), in uint8
+            cv2.bitwise_and(image, occlusion_mask_rgb, dst=tracking_img)
+            cv2.addWeighted(image, 0.5, tracking_img, 0.5, 0, dst=tracking_img)
+
+        if len(us) == 0:
+            return tracking_img
+
+        pts = np.round(np.vstack((us, vs)).T * scale).astype(np.int32)
+        node_radius = max(int(round(self.node_radius * scale)), 1)
+        line_width = max(int(round(self.line_width * scale)), 1)
+
+        # edges: consecutive edges with the same visibility form one polyline
+        if len(pts) > 1:
+            edge_visible = visible[:-1]
+            run_starts = np.concatenate(([0], np.where(edge_visible[1:] != edge_visible[:-1])[0] + 1))
+            run_ends = np.concatenate((run_starts[1:], [len(edge_visible)]))
+            for flag, color in ((True, self.visible_edge_color), (False, self.occluded_edge_color)):
+                runs = [pts[s:e+1] for s, e in zip(run_starts, run_ends) if edge_visible[s] == flag]
+                if len(runs) != 0:
+                    cv2.polylines(tracking_img, runs, False, color, line_width)
+
+        # nodes: a zero length segment with a thickness of 2*radius is the same disc as a filled cv2.circle
+        for flag, color in ((True, self.visible_node_color), (False, self.occluded_node_color)):
+            selected = pts[visible == flag]
+            if len(selected) != 0:
+                cv2.polylines(tracking_img, np.repeat(selected[:, None, :], 2, axis=1), False, color, 2*node_radius)
+
+        return tracking_img
@@ -18,9 +18,11 @@ import pickle as pkl
 
 import message_filters
 import open3d as o3d
-from scipy import ndimage
 from scipy import interpolate
 
+from visibility import project_nodes, mask_distance
+from tracking_image import TrackingImageRenderer
+
 cur_image = []
 cur_image_arr = []
 def update_rgb (data):
@@ -43,6 +45,8 @@ def update_mask (data):
     mask = ros_numpy.numpify(data)
     bmask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
 
+renderer = TrackingImageRenderer()
+
 def callback (pc):
     global cur_image
     global bmask
@@ -60,39 +64,13 @@ def callback (pc):
     # determined which nodes are occluded from mask information
     mask_dis_threshold = 10
     # projection
-    nodes_h = np.hstack((nodes, np.ones((len(nodes), 1))))
-    # proj_matrix: 3*4; nodes_h.T: 4*M; result: 3*M
-    image_coords = np.matmul(proj_matrix, nodes_h.T).T
-    us = (image_coords[:, 0] / image_coords[:, 2]).astype(int)
-    vs = (image_coords[:, 1] / image_coords[:, 2]).astype(int)
-
-    # limit the range of calculated image coordinates
-    us = np.where(us >= 1280, 1279, us)
-    vs = np.where(vs >= 720, 719, vs)
-
-    uvs = np.vstack((vs, us)).T
-    uvs_t = tuple(map(tuple, uvs.T))
-
-    # invert bmask for distance transform
-    bmask_transformed = ndimage.distance_transform_edt(255 - bmask)
-    vis = bmask_transformed[uvs_t]
-
-    tracking_img = cur_image.copy()
-    for i in range (len(image_coords)):
-        # draw circle
-        uv = (us[i], vs[i])
-        if vis[i] < mask_dis_threshold:
-            cv2.circle(tracking_img, uv, 5, (255, 150, 0), -1)
-        else:
-            cv2.circle(tracking_img, uv, 5, (255, 0, 0), -1)
-
-        # draw line
-        if i != len(image_coords)-1:
-            if vis[i] < mask_dis_threshold:
-                cv2.line(tracking_img, uv, (us[i+1], vs[i+1]), (0, 255, 0), 2)
-            else:
-                cv2.line(tracking_img, uv, (us[i+1], vs[i+1]), (255, 0, 0), 2)
-    
+    us, vs = project_nodes(nodes, proj_matrix)
+
+    # distance from each projected node to the nearest mask pixel
+    vis = mask_distance(bmask, us, vs, max_dis=2*mask_dis_threshold)
+
+    tracking_img = renderer.render(cur_image, us, vs, vis < mask_dis_threshold)
+
     tracking_img_msg = ros_numpy.msgify(Image, tracking_img, 'rgb8')
     tracking_img_pub.publish(tracking_img_msg)
 
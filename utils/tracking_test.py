@@ -2,7 +2,7 @@
 
 import rospy
 import ros_numpy
-from sensor_msgs.msg import PointCloud2, PointField, Image
+from sensor_msgs.msg import PointCloud2, PointField, Image, CameraInfo
 import sensor_msgs.point_cloud2 as pcl2
 import std_msgs.msg
 
@@ -11,30 +11,50 @@ import time
 import cv2
 import numpy as np
 import time
+import threading
+import sys
+import os
+from os.path import dirname, abspath, join
 
 import message_filters
-import open3d as o3d
-from scipy import ndimage
 
 from visualization_msgs.msg import Marker
 from visualization_msgs.msg import MarkerArray
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 from scipy.spatial.transform import Rotation as R
 
+from tracking_core import pt2pt_dis, pointcloud2_layout, xyz_view_from_buffer, extract_masked_xyz, gather_masked_xyz, \
+                          extract_masked_xyz_from_depth, color_thresholding, filter_and_downsample, \
+                          gaussian_kernel, kernel_rank_report, LeafSizeController, NodePredictor, StaticSceneDetector, \
+                          geodesic_coordinates, initialize_nodes, track_step
+from visibility import project_nodes, mask_distance, node_visibility, visibility_weights
+from shm_preprocessing import SharedFrameRing, ParallelPreprocessor
+from tracking_image import TrackingImageRenderer
+
+# shared with the package's python nodes
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'trackdlo/src'))
+from stage_metrics import metrics
+from callback_profiler import CallbackProfiler, attach_profiler_triggers
+
 proj_matrix = np.array([[918.359130859375,              0.0, 645.8908081054688, 0.0], \
                         [             0.0, 916.265869140625,   354.02392578125, 0.0], \
                         [             0.0,              0.0,               1.0, 0.0]])
-
-def pt2pt_dis_sq(pt1, pt2):
-    return np.sum(np.square(pt1 - pt2))
-
-def pt2pt_dis(pt1, pt2):
-    return np.sqrt(np.sum(np.square(pt1 - pt2)))
+# set once the camera info has replaced the default projection matrix above
+proj_matrix_received = False
 
 occlusion_mask_rgb = None
 def update_occlusion_mask(data):
 	global occlusion_mask_rgb
 	occlusion_mask_rgb = ros_numpy.numpify(data)
 
+# replaces the default projection matrix above (used by the depth image extraction and the visibility weights)
+def camera_info_callback (info):
+    global proj_matrix, proj_matrix_received
+    proj_matrix = np.array(list(info.P)).reshape(3, 4)
+    proj_matrix_received = True
+    rospy.loginfo('Received camera projection matrix:\n' + str(proj_matrix))
+    camera_info_sub.unregister()
+
 # original post: https://stackoverflow.com/a/59204638
 def rotation_matrix_from_vectors(vec1, vec2):
     """ Find the rotation matrix that aligns vec1 to vec2
@@ -115,316 +135,101 @@ def ndarray2MarkerArray (Y, marker_frame, node_color, line_color):
     
     return results
 
-def register(pts, M, mu=0, max_iter=50):
-
-    # initial guess
-    X = pts.copy()
-    Y = np.vstack((np.arange(0, 0.1, (0.1/M)), np.zeros(M), np.zeros(M))).T
-    if len(pts[0]) == 2:
-        Y = np.vstack((np.arange(0, 0.1, (0.1/M)), np.zeros(M))).T
-    s = 1
-    N = len(pts)
-    D = len(pts[0])
-
-    def get_estimates (Y, s):
-
-        # construct the P matrix
-        P = np.sum((X[None, :, :] - Y[:, None, :]) ** 2, axis=2)
-
-        c = (2 * np.pi * s) ** (D / 2)
-        c = c * mu / (1 - mu)
-        c = c * M / N
-
-        P = np.exp(-P / (2 * s))
-        den = np.sum(P, axis=0)
-        den = np.tile(den, (M, 1))
-        den[den == 0] = np.finfo(float).eps
-        den += c
-
-        P = np.divide(P, den)  # P is M*N
-        Pt1 = np.sum(P, axis=0)  # equivalent to summing from 0 to M (results in N terms)
-        P1 = np.sum(P, axis=1)  # equivalent to summing from 0 to N (results in M terms)
-        Np = np.sum(P1)
-        PX = np.matmul(P, X)
-
-        # get new Y
-        P1_expanded = np.full((D, M), P1).T
-        new_Y = PX / P1_expanded
-
-        # get new sigma2
-        Y_N_arr = np.full((N, M, 3), Y)
-        Y_N_arr = np.swapaxes(Y_N_arr, 0, 1)
-        X_M_arr = np.full((M, N, 3), X)
-        diff = Y_N_arr - X_M_arr
-        diff = np.square(diff)
-        diff = np.sum(diff, 2)
-        new_s = np.sum(np.sum(P*diff, axis=1), axis=0) / (Np*D)
-
-        return new_Y, new_s
-
-    prev_Y, prev_s = Y, s
-    new_Y, new_s = get_estimates(prev_Y, prev_s)
-    
-    for it in range (max_iter):
-        prev_Y, prev_s = new_Y, new_s
-        new_Y, new_s = get_estimates(prev_Y, prev_s)
-
-    return new_Y, new_s
-
-def sort_pts (Y_0):
-    diff = Y_0[:, None, :] - Y_0[None, :,  :]
-    diff = np.square(diff)
-    diff = np.sum(diff, 2)
-
-    N = len(diff)
-    G = diff.copy()
-
-    selected_node = np.zeros(N,).tolist()
-    selected_node[0] = True
-    Y_0_sorted = []
-        
-    reverse = 0
-    counter = 0
-    reverse_on = 0
-    insertion_counter = 0
-    last_visited_b = 0
-    while (counter < N - 1):
-        
-        minimum = 999999
-        a = 0
-        b = 0
-        for m in range(N):
-            if selected_node[m]:
-                for n in range(N):
-                    if ((not selected_node[n]) and G[m][n]):  
-                        # not in selected and there is an edge
-                        if minimum > G[m][n]:
-                            minimum = G[m][n]
-                            a = m
-                            b = n
-
-        if len(Y_0_sorted) == 0:
-            Y_0_sorted.append(Y_0[a].tolist())
-            Y_0_sorted.append(Y_0[b].tolist())
-        else:
-            if last_visited_b != a:
-                reverse += 1
-                reverse_on = a
-                insertion_counter = 0
-
-            if reverse % 2 == 1:
-                # switch direction
-                Y_0_sorted.insert(Y_0_sorted.index(Y_0[a].tolist()), Y_0[b].tolist())
-            elif reverse != 0:
-                Y_0_sorted.insert(Y_0_sorted.index(Y_0[reverse_on].tolist())+1+insertion_counter, Y_0[b].tolist())
-                insertion_counter += 1
-            else:
-                Y_0_sorted.append(Y_0[b].tolist())
-
-        last_visited_b = b
-        selected_node[b] = True
-
-        counter += 1
-
-    return np.array(Y_0_sorted)
-
-# assuming Y is sorted
-# k -- going left for k indices, going right for k indices. a total of 2k neighbors.
-def get_nearest_indices (k, Y, idx):
-    if idx - k < 0:
-        # use more neighbors from the other side?
-        indices_arr = np.append(np.arange(0, idx, 1), np.arange(idx+1, idx+k+1+np.abs(idx-k)))
-        # indices_arr = np.append(np.arange(0, idx, 1), np.arange(idx+1, idx+k+1))
-        return indices_arr
-    elif idx + k >= len(Y):
-        last_index = len(Y) - 1
-        # use more neighbots from the other side?
-        indices_arr = np.append(np.arange(idx-k-(idx+k-last_index), idx, 1), np.arange(idx+1, last_index+1, 1))
-        # indices_arr = np.append(np.arange(idx-k, idx, 1), np.arange(idx+1, last_index+1, 1))
-        return indices_arr
-    else:
-        indices_arr = np.append(np.arange(idx-k, idx, 1), np.arange(idx+1, idx+k+1, 1))
-        return indices_arr
-
-def calc_LLE_weights (k, X):
-    W = np.zeros((len(X), len(X)))
-    for i in range (0, len(X)):
-        indices = get_nearest_indices(int(k/2), X, i)
-        xi, Xi = X[i], X[indices, :]
-        component = np.full((len(Xi), len(xi)), xi).T - Xi.T
-        Gi = np.matmul(component.T, component)
-        # Gi might be singular when k is large
-        try:
-            Gi_inv = np.linalg.inv(Gi)
-        except:
-            epsilon = 0.00001
-            Gi_inv = np.linalg.inv(Gi + epsilon*np.identity(len(Gi)))
-        wi = np.matmul(Gi_inv, np.ones((len(Xi), 1))) / np.matmul(np.matmul(np.ones(len(Xi),), Gi_inv), np.ones((len(Xi), 1)))
-        W[i, indices] = np.squeeze(wi.T)
-
-    return W
-
-def indices_array(n):
-    r = np.arange(n)
-    out = np.empty((n,n,2),dtype=int)
-    out[:,:,0] = r[:,None]
-    out[:,:,1] = r
-    return out
-
-def cpd_lle (X, Y_0, beta, alpha, gamma, mu, max_iter=50, tol=0.00001, include_lle=True, use_geodesic=False, use_prev_sigma2=False, sigma2_0=None):
-
-    # define params
-    M = len(Y_0)
-    N = len(X)
-    D = len(X[0])
-
-    # initialization
-    # faster G calculation
-    diff = Y_0[:, None, :] - Y_0[None, :,  :]
-    diff = np.square(diff)
-    diff = np.sum(diff, 2)
-
-    converted_node_dis = []
-    if not use_geodesic:
-        # Gaussian Kernel
-        G = np.exp(-diff / (2 * beta**2))
-    else:
-        # compute the geodesic distances between nodes
-        seg_dis = np.sqrt(np.sum(np.square(np.diff(Y_0, axis=0)), axis=1))
-        converted_node_coord = []
-        last_pt = 0
-        converted_node_coord.append(last_pt)
-        for i in range (1, M):
-            last_pt += seg_dis[i-1]
-            converted_node_coord.append(last_pt)
-        converted_node_coord = np.array(converted_node_coord)
-        converted_node_dis = np.abs(converted_node_coord[None, :] - converted_node_coord[:, None])
-        converted_node_dis_sq = np.square(converted_node_dis)
-
-        # Gaussian Kernel
-        G = np.exp(-converted_node_dis_sq / (2 * beta**2))
-
-        # temp
-        # G[converted_node_dis > 0.07] = 0
-    
-    Y = Y_0.copy()
-
-    # initialize sigma2
-    if not use_prev_sigma2:
-        (N, D) = X.shape
-        (M, _) = Y.shape
-        diff = X[None, :, :] - Y[:, None, :]
-        err = diff ** 2
-        sigma2 = np.sum(err) / (D * M * N)
-    else:
-        sigma2 = sigma2_0
-
-    # get the LLE matrix
-    L = calc_LLE_weights(6, Y_0)
-    H = np.matmul((np.identity(M) - L).T, np.identity(M) - L)
-    
-    # loop until convergence or max_iter reached
-    for it in range (0, max_iter):
-
-        # ----- E step: compute posteriori probability matrix P -----
-        # faster P computation
-        pts_dis_sq = np.sum((X[None, :, :] - Y[:, None, :]) ** 2, axis=2)
-        c = (2 * np.pi * sigma2) ** (D / 2)
-        c = c * mu / (1 - mu)
-        c = c * M / N
-        P = np.exp(-pts_dis_sq / (2 * sigma2))
-        den = np.sum(P, axis=0)
-        den = np.tile(den, (M, 1))
-        den[den == 0] = np.finfo(float).eps
-        den += c
-        P = np.divide(P, den)
-
-        max_p_nodes = np.argmax(P, axis=0)
-
-        # if use geodesic, overwrite P
-        # this section looks long, but it is simply replacing the Euclidean distances in P with geodesic distances
-        if use_geodesic:
-            potential_2nd_max_p_nodes_1 = max_p_nodes - 1
-            potential_2nd_max_p_nodes_2 = max_p_nodes + 1
-            potential_2nd_max_p_nodes_1 = np.where(potential_2nd_max_p_nodes_1 < 0, 1, potential_2nd_max_p_nodes_1)
-            potential_2nd_max_p_nodes_2 = np.where(potential_2nd_max_p_nodes_2 > M-1, M-2, potential_2nd_max_p_nodes_2)
-            potential_2nd_max_p_nodes_1_select = np.vstack((np.arange(0, N), potential_2nd_max_p_nodes_1)).T
-            potential_2nd_max_p_nodes_2_select = np.vstack((np.arange(0, N), potential_2nd_max_p_nodes_2)).T
-            potential_2nd_max_p_1 = P.T[tuple(map(tuple, potential_2nd_max_p_nodes_1_select.T))]
-            potential_2nd_max_p_2 = P.T[tuple(map(tuple, potential_2nd_max_p_nodes_2_select.T))]
-            next_max_p_nodes = np.where(potential_2nd_max_p_1 > potential_2nd_max_p_2, potential_2nd_max_p_nodes_1, potential_2nd_max_p_nodes_2)
-            node_indices_diff = max_p_nodes - next_max_p_nodes
-            max_node_smaller_index = np.arange(0, N)[node_indices_diff < 0]
-            max_node_larger_index = np.arange(0, N)[node_indices_diff > 0]
-            dis_to_max_p_nodes = np.sqrt(np.sum(np.square(Y[max_p_nodes]-X), axis=1))
-            dis_to_2nd_largest_p_nodes = np.sqrt(np.sum(np.square(Y[next_max_p_nodes]-X), axis=1))
-            converted_P = np.zeros((M, N)).T
-
-            for idx in max_node_smaller_index:
-                converted_P[idx, 0:max_p_nodes[idx]+1] = converted_node_dis[max_p_nodes[idx], 0:max_p_nodes[idx]+1] + dis_to_max_p_nodes[idx]
-                converted_P[idx, next_max_p_nodes[idx]:M] = converted_node_dis[next_max_p_nodes[idx], next_max_p_nodes[idx]:M] + dis_to_2nd_largest_p_nodes[idx]
-
-            for idx in max_node_larger_index:
-                converted_P[idx, 0:next_max_p_nodes[idx]+1] = converted_node_dis[next_max_p_nodes[idx], 0:next_max_p_nodes[idx]+1] + dis_to_2nd_largest_p_nodes[idx]
-                converted_P[idx, max_p_nodes[idx]:M] = converted_node_dis[max_p_nodes[idx], max_p_nodes[idx]:M] + dis_to_max_p_nodes[idx]
-
-            converted_P = converted_P.T
-
-            P = np.exp(-np.square(converted_P) / (2 * sigma2))
-            den = np.sum(P, axis=0)
-            den = np.tile(den, (M, 1))
-            den[den == 0] = np.finfo(float).eps
-            c = (2 * np.pi * sigma2) ** (D / 2)
-            c = c * mu / (1 - mu)
-            c = c * M / N
-            den += c
-
-            P = np.divide(P, den)
-
-        Pt1 = np.sum(P, axis=0)
-        P1 = np.sum(P, axis=1)
-        Np = np.sum(P1)
-        PX = np.matmul(P, X)
-
-        # print(Pt1)
-    
-        # ----- M step: solve for new weights and variance -----
-        if include_lle:
-            A_matrix = np.matmul(np.diag(P1), G) + alpha * sigma2 * np.identity(M) + sigma2 * gamma * np.matmul(H, G)
-            B_matrix = PX - np.matmul(np.diag(P1) + sigma2*gamma*H, Y_0)
-        else:
-            A_matrix = np.matmul(np.diag(P1), G) + alpha * sigma2 * np.identity(M)
-            B_matrix = PX - np.matmul(np.diag(P1), Y_0)
-
-        # solve for W
-        W = np.linalg.solve(A_matrix, B_matrix)
-
-        T = Y_0 + np.matmul(G, W)
-        trXtdPt1X = np.trace(np.matmul(np.matmul(X.T, np.diag(Pt1)), X))
-        trPXtT = np.trace(np.matmul(PX.T, T))
-        trTtdP1T = np.trace(np.matmul(np.matmul(T.T, np.diag(P1)), T))
-
-        # solve for sigma^2
-        sigma2 = (trXtdPt1X - 2*trPXtT + trTtdP1T) / (Np * D)
-
-        # update Y
-        if pt2pt_dis_sq(Y, Y_0 + np.matmul(G, W)) < tol:
-            # if converged, break loop
-            Y = Y_0 + np.matmul(G, W)
-            print("iteration until convergence:", it)
-            break
-        else:
-            # keep going until max iteration is reached
-            Y = Y_0 + np.matmul(G, W)
-
-            if it == max_iter - 1:
-                print("did not converge!")
-    
-    return Y, sigma2
+# holds at most one frame. putting a new frame replaces (drops) the one that has not been taken yet,
+# so the registration stage always works on the newest frame
+class LatestFrameSlot:
+    def __init__(self):
+        self.frame = None
+        self.condition = threading.Condition()
+        self.num_received = 0
+        self.num_dropped = 0
+
+    def put(self, frame):
+        with self.condition:
+            if self.frame is not None:
+                self.num_dropped += 1
+            self.frame = frame
+            self.num_received += 1
+            self.condition.notify()
+
+    # returns None on timeout
+    def get(self, timeout=None):
+        with self.condition:
+            if self.frame is None:
+                self.condition.wait(timeout)
+            frame = self.frame
+            self.frame = None
+            return frame
+
+# decides whether a debug or visualization output should be produced for the current frame:
+# never while nobody subscribes to its publisher, and at most max_rate times per second if max_rate is set
+class LazyOutput:
+    def __init__(self, publisher, max_rate=None):
+        self.publisher = publisher
+        self.max_rate = max_rate
+        self.last_time = None
+
+    def wanted(self):
+        if self.publisher.get_num_connections() == 0:
+            return False
+        if self.max_rate is not None:
+            now = time.time()
+            if self.last_time is not None and now - self.last_time < 1.0 / self.max_rate:
+                return False
+            self.last_time = now
+        return True
+
+    def publish(self, msg):
+        self.publisher.publish(msg)
 
 initialized = False
 use_eval_rope = True
 pub_tracking_img = True
+# publish the tracking image at half the camera resolution
+tracking_img_half_resolution = False
+tracking_img_renderer = TrackingImageRenderer(half_resolution=tracking_img_half_resolution)
+use_squarem = False
+# subscribe to the aligned depth image and camera info instead of the organized point cloud
+use_depth_image = False
+# weight P with 3D node visibility (distance to the point cloud and self-occlusion), like the c++ node
+use_visibility = False
+# run preprocessing and registration in separate threads, connected by a single-slot queue that keeps the newest frame
+use_pipeline = False
+frame_slot = LatestFrameSlot()
+# run color thresholding, point extraction and downsampling in worker processes. frames are exchanged through
+# shared memory ring buffers, only slot indices and timestamps go through the queues
+use_multiprocess_preprocessing = False
+preprocessing_num_workers = 2
+preprocessor = None
+slot_frames = {}
+# warm start each frame from the constant velocity prediction of the nodes
+use_motion_prediction = False
+# start each frame's EM from the previous frame's sigma2 instead of re-estimating it
+carry_sigma2 = False
+# target frame period in seconds. if set, EM stops early so that the callback finishes within one frame period
+frame_period = None
+# if set, cpd_lle uses a rank-k approximation of its (euclidean) kernel, recomputed from the nodes of every frame
+kernel_rank = None
+node_predictor = NodePredictor()
+# adapt the downsampling leaf size to keep about target_num_pts points per frame
+use_adaptive_leaf_size = False
+# reuse the previous nodes and sigma2 when the mask and the point cloud did not change since the last registered frame
+use_static_detection = False
+static_detector = StaticSceneDetector(mask_threshold=0.02, drift_threshold=0.003, force_every=30)
+# period (s) of the /tracking_metrics summary. the metrics are also written to metrics_csv_path on shutdown,
+# set from the ~metrics_csv param in __main__ (empty string: not written)
+metrics_period = 5.0
+metrics_csv_path = os.path.expanduser('~/.ros/tracking_test_metrics.csv')
+# on-demand profiling of the next profile_num_callbacks frames, started with rosparam set <node>/profile_callbacks N,
+# rosservice call <node>/profile or kill -USR1 <pid>. results go to ~/.ros/profiles.
+# the worker processes of the multiprocess preprocessing are not profiled
+profile_num_callbacks = 100
+profile_tracemalloc = False
+profiler = CallbackProfiler(os.path.expanduser('~/.ros/profiles'), prefix='tracking_test', num_callbacks=profile_num_callbacks, use_tracemalloc=profile_tracemalloc)
+# max rate (Hz) of the mask, point cloud, marker and tracking image outputs. None: every frame.
+# outputs without subscribers are never computed
+debug_output_rate = None
+leaf_size_controller = LeafSizeController(target_num_pts=400)
 init_nodes = []
 nodes = []
 guide_nodes_Y_0 = []
@@ -432,79 +237,75 @@ sigma2 = 0
 guide_nodes_sigma2_0 = 0
 total_len = 0
 geodesic_coord = []
-def callback (rgb, pc):
-    global initialized
-    global init_nodes, nodes, sigma2
-    global total_len, geodesic_coord
-    global guide_nodes_Y_0, guide_nodes_sigma2_0
-    global params, read_params
+# preprocessing stage: color thresholding, masking, point extraction and downsampling
+# returns a frame dict for register_frame
+def preprocess (rgb, pc):  # pc is the aligned depth image if use_depth_image is True
     global occlusion_mask_rgb
 
     # log time
     cur_time_cb = time.time()
-    print('----------')
 
     # process rgb image
     cur_image = ros_numpy.numpify(rgb)
     # cur_image = cv2.cvtColor(cur_image.copy(), cv2.COLOR_BGR2RGB)
-    hsv_image = cv2.cvtColor(cur_image.copy(), cv2.COLOR_RGB2HSV)
-
-    # process point cloud
-    pc_data = ros_numpy.point_cloud2.pointcloud2_to_array(pc)
-    cur_pc = ros_numpy.point_cloud2.get_xyz_points(pc_data)
-    cur_pc = cur_pc.reshape((720, 1280, 3))
 
     # process opencv mask
     if occlusion_mask_rgb is None:
         occlusion_mask_rgb = np.ones(cur_image.shape).astype('uint8')*255
     occlusion_mask = cv2.cvtColor(occlusion_mask_rgb.copy(), cv2.COLOR_RGB2GRAY)
 
-    if not use_eval_rope:
-        # color thresholding
-        lower = (90, 90, 90)
-        upper = (120, 255, 255)
-        mask = cv2.inRange(hsv_image, lower, upper)
-    else:
-        # color thresholding
-        # --- rope blue ---
-        lower = (90, 60, 40)
-        upper = (130, 255, 255)
-        mask_dlo = cv2.inRange(hsv_image, lower, upper).astype('uint8')
-
-        # --- tape red ---
-        lower = (130, 60, 40)
-        upper = (255, 255, 255)
-        mask_red_1 = cv2.inRange(hsv_image, lower, upper).astype('uint8')
-        lower = (0, 60, 40)
-        upper = (10, 255, 255)
-        mask_red_2 = cv2.inRange(hsv_image, lower, upper).astype('uint8')
-        mask_marker = cv2.bitwise_or(mask_red_1.copy(), mask_red_2.copy()).astype('uint8')
-
-        # combine masks
-        mask = cv2.bitwise_or(mask_marker.copy(), mask_dlo.copy())
-        mask = cv2.bitwise_and(mask.copy(), occlusion_mask.copy())
+    with metrics.timer('thresholding'):
+        mask = color_thresholding(cur_image, occlusion_mask, use_eval_rope)
 
     bmask = mask.copy() # for checking visibility, max = 255
-    mask = cv2.cvtColor(mask.copy(), cv2.COLOR_GRAY2BGR)
 
-    # publish mask
-    mask_img_msg = ros_numpy.msgify(Image, mask, 'rgb8')
-    mask_img_pub.publish(mask_img_msg)
+    # process point cloud. only the masked points are read from the message
+    with metrics.timer('extraction'):
+        if use_depth_image:
+            filtered_pc = extract_masked_xyz_from_depth(ros_numpy.numpify(pc), bmask, proj_matrix)
+        else:
+            filtered_pc = extract_masked_xyz(pc, bmask)
 
-    mask = (mask/255).astype(int)
+    # downsample
+    leaf_size = current_leaf_size()
+    with metrics.timer('downsampling'):
+        filtered_pc = filter_and_downsample(filtered_pc, leaf_size)
 
-    filtered_pc = cur_pc*mask
-    filtered_pc = filtered_pc[((filtered_pc[:, :, 0] != 0) | (filtered_pc[:, :, 1] != 0) | (filtered_pc[:, :, 2] != 0))]
-    # filtered_pc = filtered_pc[filtered_pc[:, 2] < 0.705]
-    filtered_pc = filtered_pc[filtered_pc[:, 2] > 0.58]
+    with metrics.timer('publishing'):
+        publish_preprocessed(bmask, filtered_pc, leaf_size)
 
-    # downsample with open3d
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(filtered_pc)
-    downpcd = pcd.voxel_down_sample(voxel_size=0.005)
-    filtered_pc = np.asarray(downpcd.points)
+    metrics.record('preprocess', time.time() - cur_time_cb)
 
-    rospy.loginfo("Downsampled point cloud size: " + str(len(filtered_pc)))
+    return {'stamp': rgb.header.stamp,
+            'receive_time': cur_time_cb,
+            'image': cur_image,
+            'occlusion_mask_rgb': occlusion_mask_rgb,
+            'bmask': bmask,
+            'filtered_pc': filtered_pc}
+
+def current_leaf_size ():
+    if use_adaptive_leaf_size:
+        return leaf_size_controller.leaf_size
+    return 0.005
+
+# publish the mask and the downsampled point cloud, update the leaf size for the next frame
+def publish_preprocessed (bmask, filtered_pc, leaf_size):
+    # publish mask
+    if mask_img_output.wanted():
+        mask = cv2.cvtColor(bmask, cv2.COLOR_GRAY2BGR)
+        mask_img_msg = ros_numpy.msgify(Image, mask, 'rgb8')
+        mask_img_output.publish(mask_img_msg)
+
+    rospy.logdebug("Downsampled point cloud size: " + str(len(filtered_pc)) + ", leaf size: " + str(leaf_size))
+    # published on /tracking_metrics
+    metrics.gauge('leaf_size', leaf_size)
+    metrics.gauge('downsampled_points', len(filtered_pc))
+    if use_adaptive_leaf_size:
+        # the next frame uses the updated leaf size
+        leaf_size_controller.update(len(filtered_pc))
+
+    if not pc_output.wanted():
+        return
 
     # add color
     pc_rgba = struct.unpack('I', struct.pack('BBBB', 255, 40, 40, 255))[0]
@@ -515,106 +316,317 @@ def callback (rgb, pc):
     # filtered_pc = filtered_pc.reshape((len(filtered_pc)*len(filtered_pc[0]), 3))
     header.stamp = rospy.Time.now()
     converted_points = pcl2.create_cloud(header, fields, filtered_pc_colored)
-    pc_pub.publish(converted_points)
+    pc_output.publish(converted_points)
+
+# worker side of the multiprocess preprocessing. views are the arrays of one SharedFrameRing slot:
+# rgb, occlusion and raw (cloud or depth bytes) are inputs, bmask and points are outputs
+def preprocess_slot (views, meta):
+    bmask = color_thresholding(views['rgb'], views['occlusion'], use_eval_rope)
+    views['bmask'][:] = bmask
+
+    if meta['depth_dtype'] is not None:
+        depth = views['raw'][:meta['num_bytes']].view(meta['depth_dtype']).reshape(bmask.shape)
+        filtered_pc = extract_masked_xyz_from_depth(depth, bmask, meta['proj_matrix'])
+    else:
+        filtered_pc = gather_masked_xyz(xyz_view_from_buffer(views['raw'], meta['layout']), bmask)
+
+    filtered_pc = filter_and_downsample(filtered_pc, meta['leaf_size'])
+    views['points'][:len(filtered_pc)] = filtered_pc
+    return len(filtered_pc)
+
+# bytes of the cloud (or depth image) message that the workers read, the depth dtype and the cloud layout
+def raw_frame (pc):
+    if use_depth_image:
+        depth = np.ascontiguousarray(ros_numpy.numpify(pc))
+        return depth.view(np.uint8).reshape(-1), depth.dtype.str, None
+    return np.frombuffer(pc.data, dtype=np.uint8), None, pointcloud2_layout(pc)
+
+# creates the shared memory ring for frames like the given messages and starts the workers.
+# called in __main__ before the subscribers are registered
+def start_preprocessor (rgb, pc):
+    global preprocessor
+    h, w = rgb.height, rgb.width
+    raw, _, _ = raw_frame(pc)
+    ring = SharedFrameRing({'rgb': ((h, w, 3), np.uint8),
+                            'occlusion': ((h, w), np.uint8),
+                            'raw': ((len(raw),), np.uint8),
+                            'bmask': ((h, w), np.uint8),
+                            'points': ((h*w, 3), np.float32)}, num_slots=preprocessing_num_workers+1)
+    preprocessor = ParallelPreprocessor(ring, preprocess_slot, preprocessed_callback, num_workers=preprocessing_num_workers,
+                                        on_failure=preprocessing_failed)
+    preprocessor.start()
+    rospy.on_shutdown(preprocessor.shutdown)
+
+# main process side: copy the messages into a free slot and hand the slot index to the workers
+def submit_frame (rgb, pc):
+    global occlusion_mask_rgb
+
+    cur_time_cb = time.time()
+    cur_image = ros_numpy.numpify(rgb)
+    raw, depth_dtype, layout = raw_frame(pc)
+
+    if occlusion_mask_rgb is None:
+        occlusion_mask_rgb = np.ones(cur_image.shape).astype('uint8')*255
+    cur_occlusion_mask_rgb = occlusion_mask_rgb
+
+    slot = preprocessor.acquire()
+    if slot is None:
+        return
+    views = preprocessor.ring.slot(slot)
+    if cur_image.shape != views['rgb'].shape or len(raw) > len(views['raw']):
+        rospy.logwarn('frame size changed, dropping frame')
+        preprocessor.release(slot)
+        return
+
+    views['rgb'][:] = cur_image
+    views['occlusion'][:] = cv2.cvtColor(cur_occlusion_mask_rgb, cv2.COLOR_RGB2GRAY)
+    views['raw'][:len(raw)] = raw
+    # the image and the occlusion mask stay in this process, the slot is not reused before preprocessed_callback returns
+    slot_frames[slot] = {'image': cur_image, 'occlusion_mask_rgb': cur_occlusion_mask_rgb}
+    preprocessor.submit(slot, {'stamp': rgb.header.stamp,
+                               'receive_time': cur_time_cb,
+                               'slot': slot,
+                               'leaf_size': current_leaf_size(),
+                               'layout': layout,
+                               'depth_dtype': depth_dtype,
+                               'num_bytes': len(raw),
+                               'proj_matrix': proj_matrix})
+
+# collector thread: copy the results out of the slot, then continue as in callback
+def preprocessed_callback (views, meta, num_pts):
+    # the worker stages run in other processes, only the time from submission to here is recorded
+    metrics.record('preprocess', time.time() - meta['receive_time'])
+    local_frame = slot_frames.pop(meta['slot'])
+    bmask = views['bmask'].copy()
+    filtered_pc = views['points'][:num_pts].copy()
+    with metrics.timer('publishing'):
+        publish_preprocessed(bmask, filtered_pc, meta['leaf_size'])
+
+    frame = {'stamp': meta['stamp'],
+             'receive_time': meta['receive_time'],
+             'image': local_frame['image'],
+             'occlusion_mask_rgb': local_frame['occlusion_mask_rgb'],
+             'bmask': bmask,
+             'filtered_pc': filtered_pc}
+    if use_pipeline:
+        frame_slot.put(frame)
+    else:
+        profiled_register_frame(frame)
+
+# collector thread: the worker failed on this frame, nothing is registered
+def preprocessing_failed (meta):
+    slot_frames.pop(meta['slot'], None)
+
+# registration stage: initialization or cpd_lle, then publish the results
+def register_frame (frame):
+    global initialized
+    global init_nodes, nodes, sigma2
+    global total_len, geodesic_coord
+    global guide_nodes_Y_0, guide_nodes_sigma2_0
+    global params, read_params
 
-    rospy.logwarn('callback before initialized: ' + str((time.time() - cur_time_cb)*1000) + ' ms')
+    cur_time_cb = frame['receive_time']
+    cur_image = frame['image']
+    bmask = frame['bmask']
+    filtered_pc = frame['filtered_pc']
 
     # register nodes
     if not initialized:
 
-        init_nodes, sigma2 = register(filtered_pc, 40, 0.05, max_iter=100)
-        init_nodes = sort_pts(init_nodes)
+        init_nodes, sigma2 = initialize_nodes(filtered_pc, 40, 0.05, max_iter=100)
 
         nodes = init_nodes.copy()
 
         # compute preset coord and total len. one time action
-        seg_dis = np.sqrt(np.sum(np.square(np.diff(init_nodes, axis=0)), axis=1))
-        geodesic_coord = []
-        last_pt = 0
-        geodesic_coord.append(last_pt)
-        for i in range (1, len(init_nodes)):
-            last_pt += seg_dis[i-1]
-            geodesic_coord.append(last_pt)
-        geodesic_coord = np.array(geodesic_coord)
-        total_len = np.sum(np.sqrt(np.sum(np.square(np.diff(init_nodes, axis=0)), axis=1)))
+        geodesic_coord = geodesic_coordinates(init_nodes)
+        total_len = geodesic_coord[-1]
+
+        if kernel_rank is not None:
+            # the same euclidean kernel that cpd_lle builds from the nodes, here for the initial nodes
+            rospy.loginfo('Low rank euclidean kernel of the initial nodes, rank ' + str(kernel_rank) + ':')
+            for rank, err in kernel_rank_report(gaussian_kernel(init_nodes, 0.7), [5, 10, 20, 40, kernel_rank]):
+                rospy.loginfo('  rank ' + str(rank) + ': relative error ' + str(err))
 
         initialized = True
+        metrics.record('initialization', time.time() - cur_time_cb)
         # header.stamp = rospy.Time.now()
         # converted_init_nodes = pcl2.create_cloud(header, fields, init_nodes)
         # nodes_pub.publish(converted_init_nodes)
 
     # cpd
     if initialized:
-        # determined which nodes are occluded from mask information
+        # determined which nodes are occluded from mask information (only used by the tracking image)
         mask_dis_threshold = 10
-        # projection
-        init_nodes_h = np.hstack((init_nodes, np.ones((len(init_nodes), 1))))
-        # proj_matrix: 3*4; nodes_h.T: 4*M; result: 3*M
-        image_coords = np.matmul(proj_matrix, init_nodes_h.T).T
-        us = (image_coords[:, 0] / image_coords[:, 2]).astype(int)
-        vs = (image_coords[:, 1] / image_coords[:, 2]).astype(int)
-
-        # temp
-        us = np.where(us >= 1280, 1279, us)
-        vs = np.where(vs >= 720, 719, vs)
-
-        uvs = np.vstack((vs, us)).T
-        uvs_t = tuple(map(tuple, uvs.T))
-
-        # invert bmask for distance transform
-        bmask_transformed = ndimage.distance_transform_edt(255 - bmask)
-        # bmask_transformed = bmask_transformed / np.amax(bmask_transformed)
-        vis = bmask_transformed[uvs_t]
-        # occluded_nodes = np.where(vis > mask_dis_threshold)[0]
-
-        # log time
-        cur_time = time.time()
-        nodes, sigma2 = cpd_lle(filtered_pc, nodes, 0.7, 5, 1, 0.05, 50, 0.00001, True, False, False, sigma2)
-        rospy.logwarn('tracking_step total: ' + str((time.time() - cur_time)*1000) + ' ms')
+        draw_tracking_img = pub_tracking_img and tracking_img_output.wanted()
+        if draw_tracking_img:
+            # projection
+            us, vs = project_nodes(init_nodes, proj_matrix)
+
+            # distance from each projected node to the nearest mask pixel
+            vis = mask_distance(bmask, us, vs, max_dis=2*mask_dis_threshold)
+            # occluded_nodes = np.where(vis > mask_dis_threshold)[0]
+
+        cur_stamp = frame['stamp'].to_sec()
+        skipped = use_static_detection and static_detector.is_static(bmask, filtered_pc)
+        if skipped:
+            # nothing moved since the last registered frame: keep the nodes and sigma2
+            em_info = {'converged': True, 'iterations': 0, 'error': 0.0, 'timed_out': False}
+            node_predictor.add(cur_stamp, nodes)
+            metrics.count('static_frames_skipped')
+        else:
+            # 3D visibility
+            node_weights = None
+            pt_weights = None
+            if use_visibility and not proj_matrix_received:
+                rospy.logwarn_throttle(5, 'No camera info received yet, visibility weighting is skipped')
+            elif use_visibility:
+                visibility_start = time.time()
+                visible_nodes, node_pt_dists, pt_node_dists = node_visibility(init_nodes, filtered_pc, proj_matrix, geodesic_coord=geodesic_coord)
+                rospy.logdebug('Visible nodes: ' + str(len(visible_nodes)) + '/' + str(len(init_nodes)))
+                if len(visible_nodes) != len(init_nodes) and len(visible_nodes) != 0:
+                    node_weights, pt_weights = visibility_weights(node_pt_dists, pt_node_dists, visible_nodes=visible_nodes)
+                metrics.record('visibility', time.time() - visibility_start)
+
+            # log time
+            cur_time = time.time()
+            if use_motion_prediction and len(node_predictor.history) != 0:
+                Y_0 = node_predictor.predict(cur_stamp)
+            else:
+                Y_0 = nodes
+            deadline = None
+            if frame_period is not None:
+                deadline = cur_time_cb + frame_period
+            nodes, sigma2, em_info = track_step(filtered_pc, Y_0, sigma2, carry_sigma2, use_squarem=use_squarem, deadline=deadline, kernel_rank=kernel_rank, node_weights=node_weights, pt_weights=pt_weights)
+            node_predictor.add(cur_stamp, nodes)
+            metrics.record('cpd_lle', time.time() - cur_time)
+            rospy.logdebug('cpd_lle: ' + str(em_info['iterations']) + ' iterations, converged: ' + str(em_info['converged']) + ', timed out: ' + str(em_info['timed_out']))
+            if use_static_detection:
+                static_detector.set_reference(bmask, filtered_pc)
+
+        publish_start = time.time()
+
+        # publish registration metadata for this frame
+        em_status = DiagnosticStatus()
+        em_status.name = 'cpd_lle'
+        em_status.level = DiagnosticStatus.OK if em_info['converged'] else DiagnosticStatus.WARN
+        em_status.message = 'converged' if em_info['converged'] else ('deadline reached' if em_info['timed_out'] else 'max_iter reached')
+        if skipped:
+            em_status.message = 'static scene, registration skipped'
+        em_status.values = [KeyValue('skipped', str(skipped)),
+                            KeyValue('converged', str(em_info['converged'])),
+                            KeyValue('iterations', str(em_info['iterations'])),
+                            KeyValue('error', str(em_info['error'])),
+                            KeyValue('sigma2', str(sigma2))]
+        if 'kernel_rel_err' in em_info:
+            em_status.values.append(KeyValue('kernel_rel_err', str(em_info['kernel_rel_err'])))
+        em_info_msg = DiagnosticArray()
+        em_info_msg.header.stamp = frame['stamp']
+        em_info_msg.status = [em_status]
+        em_info_pub.publish(em_info_msg)
 
         init_nodes = nodes.copy()
 
-        results = ndarray2MarkerArray(nodes, "camera_color_optical_frame", [255, 150, 0, 0.75], [0, 255, 0, 0.75])
-        results_pub.publish(results)
+        if results_output.wanted():
+            results = ndarray2MarkerArray(nodes, "camera_color_optical_frame", [255, 150, 0, 0.75], [0, 255, 0, 0.75])
+            results_output.publish(results)
 
-        if pub_tracking_img:
+        if draw_tracking_img:
             # project and pub tracking image
-            nodes_h = np.hstack((nodes, np.ones((len(nodes), 1))))
-
-            # proj_matrix: 3*4; nodes_h.T: 4*M; result: 3*M
-            image_coords = np.matmul(proj_matrix, nodes_h.T).T
-            us = (image_coords[:, 0] / image_coords[:, 2]).astype(int)
-            vs = (image_coords[:, 1] / image_coords[:, 2]).astype(int)
-
-            cur_image_masked = cv2.bitwise_and(cur_image, occlusion_mask_rgb)
-            tracking_img = (cur_image*0.5 + cur_image_masked*0.5).astype(np.uint8)
-
-            for i in range (len(image_coords)):
-                # draw circle
-                uv = (us[i], vs[i])
-                if vis[i] < mask_dis_threshold:
-                    cv2.circle(tracking_img, uv, 5, (255, 150, 0), -1)
-                else:
-                    cv2.circle(tracking_img, uv, 5, (255, 0, 0), -1)
-
-                # draw line
-                if i != len(image_coords)-1:
-                    if vis[i] < mask_dis_threshold:
-                        cv2.line(tracking_img, uv, (us[i+1], vs[i+1]), (0, 255, 0), 2)
-                    else:
-                        cv2.line(tracking_img, uv, (us[i+1], vs[i+1]), (255, 0, 0), 2)
-            
+            us, vs = project_nodes(nodes, proj_matrix)
+
+            tracking_img = tracking_img_renderer.render(cur_image, us, vs, vis < mask_dis_threshold, frame['occlusion_mask_rgb'])
             tracking_img_msg = ros_numpy.msgify(Image, tracking_img, 'rgb8')
-            tracking_img_pub.publish(tracking_img_msg)
+            tracking_img_output.publish(tracking_img_msg)
+
+        metrics.record('publishing_results', time.time() - publish_start)
+        # from message arrival, and from the camera timestamp
+        metrics.record('frame', time.time() - cur_time_cb)
+        metrics.record('end_to_end', (rospy.Time.now() - frame['stamp']).to_sec())
+
+# periodic summary of the stage metrics, one DiagnosticStatus per stage plus one for the counters
+def publish_metrics (event):
+    metrics_msg = DiagnosticArray()
+    metrics_msg.header.stamp = rospy.Time.now()
+    for stage, s in sorted(metrics.summary().items()):
+        status = DiagnosticStatus()
+        status.name = stage
+        status.values = [KeyValue(key, str(s[key])) for key in ['count', 'mean', 'p50', 'p95', 'p99', 'max']]
+        metrics_msg.status.append(status)
+
+    # frames dropped by the pipeline and the multiprocess preprocessing are counted by their queues
+    counters = dict(metrics.counters)
+    if use_pipeline:
+        counters['pipeline_received'] = frame_slot.num_received
+        counters['pipeline_dropped'] = frame_slot.num_dropped
+    if preprocessor is not None:
+        counters['preprocessing_submitted'] = preprocessor.num_submitted
+        counters['preprocessing_dropped'] = preprocessor.num_dropped
+    status = DiagnosticStatus()
+    status.name = 'counters'
+    status.values = [KeyValue(name, str(n)) for name, n in sorted(counters.items())]
+    metrics_msg.status.append(status)
+
+    status = DiagnosticStatus()
+    status.name = 'gauges'
+    status.values = [KeyValue(name, str(value)) for name, value in sorted(dict(metrics.gauges).items())]
+    metrics_msg.status.append(status)
+    metrics_pub.publish(metrics_msg)
+
+def dump_metrics ():
+    rospy.loginfo('Stage metrics:\n' + metrics.summary_string())
+    if metrics_csv_path != '':
+        metrics.dump_csv(metrics_csv_path)
+        rospy.loginfo('Stage metrics written to ' + metrics_csv_path)
+
+# replaced by the profiler wrapper when registration runs in its own thread
+profiled_register_frame = register_frame
 
-        rospy.logwarn('callback total: ' + str((time.time() - cur_time_cb)*1000) + ' ms')
+def callback (rgb, pc):
+    # the depth image is back-projected with the camera's projection matrix, frames before it arrives are dropped
+    if use_depth_image and not proj_matrix_received:
+        rospy.logwarn_throttle(5, 'No camera info received yet, dropping depth frames')
+        return
+    if use_multiprocess_preprocessing:
+        # preprocessed_callback picks the frame up when a worker is done with it
+        submit_frame(rgb, pc)
+    elif use_pipeline:
+        # registration_loop picks the frame up in the other thread
+        frame_slot.put(preprocess(rgb, pc))
+    else:
+        register_frame(preprocess(rgb, pc))
+
+# registration thread for the pipelined mode
+def registration_loop ():
+    while not rospy.is_shutdown():
+        frame = frame_slot.get(timeout=0.1)
+        if frame is not None:
+            profiled_register_frame(frame)
 
 if __name__=='__main__':
 
     rospy.init_node('tracking_test', anonymous=True)
-
-    rgb_sub = message_filters.Subscriber('/camera/color/image_raw', Image)
-    pc_sub = message_filters.Subscriber('/camera/depth/color/points', PointCloud2)
+    metrics_csv_path = rospy.get_param('~metrics_csv', metrics_csv_path)
+
+    # in the pipelined mode, stale messages are dropped instead of queued
+    sub_kwargs = {}
+    if use_pipeline:
+        sub_kwargs = {'queue_size': 1, 'buff_size': 2**26}
+
+    # the workers are started before the subscribers are registered, the ring is sized by the first frame
+    if use_multiprocess_preprocessing:
+        pc_topic = '/camera/aligned_depth_to_color/image_raw' if use_depth_image else '/camera/depth/color/points'
+        first_rgb = rospy.wait_for_message('/camera/color/image_raw', Image)
+        first_pc = rospy.wait_for_message(pc_topic, Image if use_depth_image else PointCloud2)
+        start_preprocessor(first_rgb, first_pc)
+
+    rgb_sub = message_filters.Subscriber('/camera/color/image_raw', Image, **sub_kwargs)
+    if use_depth_image:
+        camera_info_sub = rospy.Subscriber('/camera/aligned_depth_to_color/camera_info', CameraInfo, camera_info_callback)
+        pc_sub = message_filters.Subscriber('/camera/aligned_depth_to_color/image_raw', Image, **sub_kwargs)
+    else:
+        # the point cloud is in the color camera frame, the visibility weights project into the color image
+        camera_info_sub = rospy.Subscriber('/camera/color/camera_info', CameraInfo, camera_info_callback)
+        pc_sub = message_filters.Subscriber('/camera/depth/color/points', PointCloud2, **sub_kwargs)
 
     # header
     header = std_msgs.msg.Header()
@@ -628,10 +640,34 @@ if __name__=='__main__':
     results_pub = rospy.Publisher ('/results', MarkerArray, queue_size=10)
     tracking_img_pub = rospy.Publisher ('/tracking_img', Image, queue_size=10)
     mask_img_pub = rospy.Publisher('/mask', Image, queue_size=10)
+    em_info_pub = rospy.Publisher('/tracking_info', DiagnosticArray, queue_size=10)
+    metrics_pub = rospy.Publisher('/tracking_metrics', DiagnosticArray, queue_size=10)
+    metrics_timer = rospy.Timer(rospy.Duration(metrics_period), publish_metrics)
+    rospy.on_shutdown(dump_metrics)
+
+    # debug and visualization outputs are only produced for subscribers
+    mask_img_output = LazyOutput(mask_img_pub, debug_output_rate)
+    pc_output = LazyOutput(pc_pub, debug_output_rate)
+    results_output = LazyOutput(results_pub, debug_output_rate)
+    tracking_img_output = LazyOutput(tracking_img_pub, debug_output_rate)
 
     opencv_mask_sub = rospy.Subscriber('/mask_with_occlusion', Image, update_occlusion_mask)
 
+    # a profiling capture counts frames where registration happens. when registration runs in another thread,
+    # both threads are profiled
+    if use_pipeline or use_multiprocess_preprocessing:
+        profiled_register_frame = profiler.wrap(register_frame)
+        profiled_callback = profiler.wrap(callback, counted=False)
+    else:
+        profiled_callback = profiler.wrap(callback)
+    attach_profiler_triggers(profiler)
+
     ts = message_filters.TimeSynchronizer([rgb_sub, pc_sub], 10)
-    ts.registerCallback(callback)
+    ts.registerCallback(profiled_callback)
+
+    if use_pipeline:
+        registration_thread = threading.Thread(target=registration_loop)
+        registration_thread.daemon = True
+        registration_thread.start()
 
     rospy.spin()
\ No newline at end of file
@@ -0,0 +1,120 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# project 3D nodes (M*3, camera frame) to integer pixel coordinates
+# proj_matrix: 3*4; nodes_h.T: 4*M; result: 3*M
+def project_nodes (Y, proj_matrix):
+    Y_h = np.hstack((Y, np.ones((len(Y), 1))))
+    image_coords = np.matmul(proj_matrix, Y_h.T).T
+    us = (image_coords[:, 0] / image_coords[:, 2]).astype(int)
+    vs = (image_coords[:, 1] / image_coords[:, 2]).astype(int)
+    return us, vs
+
+# limit pixel coordinates to the image, at both the lower and the upper edge
+def clip_pixels (us, vs, image_shape):
+    us = np.clip(us, 0, image_shape[1]-1)
+    vs = np.clip(vs, 0, image_shape[0]-1)
+    return us, vs
+
+# offsets of a (2*max_dis+1)^2 window and their distances to the window center, sorted by distance
+window_cache = {}
+def get_window (max_dis):
+    if max_dis not in window_cache:
+        r = int(np.ceil(max_dis))
+        dvs, dus = np.mgrid[-r:r+1, -r:r+1]
+        dis = np.sqrt(dvs**2 + dus**2).flatten()
+        keep = dis <= max_dis
+        order = np.argsort(dis[keep], kind='stable')
+        window_cache[max_dis] = (dus.flatten()[keep][order], dvs.flatten()[keep][order], dis[keep][order])
+    return window_cache[max_dis]
+
+# euclidean distance from each pixel (us[i], vs[i]) to the nearest nonzero pixel of mask.
+# only the pixels within max_dis of each query are inspected, so the cost grows with the number of queries and not with
+# the image size. queries without a mask pixel within max_dis get np.inf.
+# for distances <= max_dis this is the same as ndimage.distance_transform_edt(255 - mask)[vs, us]
+def mask_distance (mask, us, vs, max_dis=20):
+    us, vs = clip_pixels(np.asarray(us), np.asarray(vs), mask.shape)
+    dus, dvs, dis = get_window(max_dis)
+
+    # M * window_size pixel coordinates; pixels outside the image do not count as mask pixels
+    window_us = us[:, None] + dus[None, :]
+    window_vs = vs[:, None] + dvs[None, :]
+    inside = (window_us >= 0) & (window_us < mask.shape[1]) & (window_vs >= 0) & (window_vs < mask.shape[0])
+    hit = np.zeros(window_us.shape, dtype=bool)
+    hit[inside] = mask[window_vs[inside], window_us[inside]] > 0
+
+    # the window is sorted by distance, so the first hit is the nearest mask pixel
+    first_hit = np.argmax(hit, axis=1)
+    result = dis[first_hit]
+    result[~np.any(hit, axis=1)] = np.inf
+    return result
+
+# shortest distance from each pixel (us[i], vs[i]) to each segment (seg_us[j], seg_vs[j]) -- (seg_us[j+1], seg_vs[j+1])
+# returns an M * (len(seg_us)-1) array
+def pixel_segment_distance (us, vs, seg_us, seg_vs):
+    p = np.vstack((us, vs)).T[:, None, :].astype(float)
+    a = np.vstack((seg_us[:-1], seg_vs[:-1])).T[None, :, :].astype(float)
+    b = np.vstack((seg_us[1:], seg_vs[1:])).T[None, :, :].astype(float)
+    ab = b - a
+    ab_len_sq = np.sum(np.square(ab), axis=2)
+    ab_len_sq[ab_len_sq == 0] = 1
+    t = np.clip(np.sum((p - a) * ab, axis=2) / ab_len_sq, 0, 1)
+    return np.sqrt(np.sum(np.square(p - (a + t[:, :, None] * ab)), axis=2))
+
+# 3D node visibility, same criteria as the c++ node:
+#   a node is visible if it is within visibility_threshold (m) of the point cloud X and, when the edges of Y are drawn
+#   from the closest to the camera to the farthest with a width of dlo_pixel_width pixels, its projection is not covered
+#   by an edge drawn before either of its own edges (self-occlusion)
+# if geodesic_coord is provided, gaps of at most d_vis (m) between visible nodes are filled
+# returns the sorted visible node indices, the node to point cloud distances (M) and the point to node distances (N)
+def node_visibility (Y, X, proj_matrix, visibility_threshold=0.008, dlo_pixel_width=40, geodesic_coord=None, d_vis=0.06):
+    M = len(Y)
+
+    # nearest neighbor distances in both directions
+    node_pt_dists, _ = cKDTree(X).query(Y)
+    pt_node_dists, _ = cKDTree(Y).query(X)
+
+    # rank edges by the distance of their midpoints to the camera
+    edge_camera_dists = np.linalg.norm((Y[:-1] + Y[1:]) / 2, axis=1)
+    edge_rank = np.empty(M-1, dtype=int)
+    edge_rank[np.argsort(edge_camera_dists, kind='stable')] = np.arange(M-1)
+
+    # a node is checked when the first of its (up to two) edges is drawn
+    node_rank = np.full(M, M, dtype=int)
+    node_rank[:-1] = edge_rank
+    node_rank[1:] = np.minimum(node_rank[1:], edge_rank)
+
+    us, vs = project_nodes(Y, proj_matrix)
+    covered_by = pixel_segment_distance(us, vs, us, vs) <= dlo_pixel_width / 2
+    covered_by &= edge_rank[None, :] < node_rank[:, None]
+    self_occluded = np.any(covered_by, axis=1)
+
+    visible_nodes = np.where((~self_occluded) & (node_pt_dists <= visibility_threshold))[0]
+
+    # minor mid-section occlusion is usually fine
+    # extend visible nodes so that small gaps are filled
+    if geodesic_coord is not None and len(visible_nodes) > 1:
+        visible_nodes_extended = [visible_nodes[0]]
+        for i in range (0, len(visible_nodes)-1):
+            if np.abs(geodesic_coord[visible_nodes[i+1]] - geodesic_coord[visible_nodes[i]]) <= d_vis:
+                visible_nodes_extended += list(range(visible_nodes[i]+1, visible_nodes[i+1]))
+            visible_nodes_extended.append(visible_nodes[i+1])
+        visible_nodes = np.array(visible_nodes_extended)
+
+    return visible_nodes, node_pt_dists, pt_node_dists
+
+# membership probability weights adapted from cdcpd (same as P_vis in the c++ node), normalized to a mean of 1:
+# nodes far from the point cloud and points far from every node contribute less to P.
+# if visible_nodes (from node_visibility) is given, the weight of every other node (self-occluded, or too far from the
+# point cloud) is at most occluded_weight before the normalization, so hidden nodes are mostly moved by the
+# coherence and LLE terms instead of by the points in front of them
+def visibility_weights (node_pt_dists, pt_node_dists, k_vis=50, visible_nodes=None, occluded_weight=0.01):
+    node_weights = np.exp(-k_vis * node_pt_dists)
+    if visible_nodes is not None:
+        hidden = np.ones(len(node_weights), dtype=bool)
+        hidden[np.asarray(visible_nodes, dtype=int)] = False
+        node_weights[hidden] = np.minimum(node_weights[hidden], occluded_weight)
+    node_weights = node_weights / np.mean(node_weights)
+    pt_weights = np.exp(-k_vis * pt_node_dists)
+    pt_weights = pt_weights / np.mean(pt_weights)
+    return node_weights, pt_weights